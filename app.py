@@ -1,3 +1,8 @@
+import shutil
+import threading
+import zlib
+from collections.abc import Mapping
+from concurrent.futures import Future
 from zipfile import ZipFile, BadZipFile
 from io import TextIOWrapper
 from tempfile import TemporaryFile
@@ -9,8 +14,27 @@ from json import dumps
 from azure.core import exceptions as azure_exceptions
 
 from modules.aims_saas.aims_saas_api_client import *
+from modules.aims_saas.aims_saas_async_client import AsyncAIMSSaaSRunner
+from modules.aims_saas.article_cache import ArticleDeltaCache
+from modules.aims_saas.upload_format import ArticleUploadFormat
+from modules.sduk.active_pe_index import ActivePEIndex
+from modules.sduk.store_lanes import StoreLanes, when_all_done
+from modules.sduk.pipeline import drain_in_order, iter_batches
+from modules.sduk.scheduler import Scheduler
+from modules.sduk.queue_index import (
+    QueueNameError,
+    due_queue_blobs,
+    parse_queue_blob_name,
+    queue_blob_name,
+)
+from modules.sduk.sidecar import (
+    SidecarError,
+    decode_sidecar,
+    encode_sidecar,
+    sidecar_blob_name,
+)
 from modules.sduk.sduk import *
-from modules.sduk.blob import AzureBlob, BlobError
+from modules.sduk.storage import BlobError, RangedBlobFile, open_blob_store
 from modules.sduk.common import *
 from env import (
     BLOB_ARCHIVE_DIR,
@@ -18,10 +42,33 @@ from env import (
     BLOB_QUEUE_DIR,
     BLOB_REJECT_DIR,
     BLOB_ACTIVE_DIR,
+    AIMS_SAAS_ASYNC,
+    AIMS_SAAS_STREAM_WINDOW_ARTICLES,
+    AIMS_SAAS_STREAM_WINDOWS_IN_FLIGHT,
+    CSV_ENCODING,
 )
 
-AB = AzureBlob()
+AB = open_blob_store()
 SaasClient = AIMSSaaSAPIClient()
+# One event loop and pooled client all lanes upload through if AIMS_SAAS_ASYNC
+AsyncSaasClient = AsyncAIMSSaaSRunner(SaasClient) if AIMS_SAAS_ASYNC else None
+ArticleCache = ArticleDeltaCache()
+# Data fields AIMS stores, the rest is dropped before articles are sent
+UploadFormat = ArticleUploadFormat(fetch=SaasClient.get_article_upload_format)
+# PLU columns needed before sending even if AIMS does not store them
+PLU_PARSE_FIELDS = ("OP_CODE",)
+PEIndex = ActivePEIndex()
+# Ordered per-store queues all AIMS pushes go through
+Lanes = StoreLanes()
+# Blobs whose pushes are still running, skipped until they are finished
+PendingBlobs = set()
+# {store_id: queued PLU file} whose push failed and is kept for a retry, the
+# later queued files of the store wait for it
+FailedQueuedStores = {}
+# {queued file: store ids} a kept queued file still has to be sent to
+QueuedRetryStores = {}
+# Next due times of the main loop tasks
+Schedule = Scheduler(tasks=("active_pe", "queued", "input"))
 
 
 def main(logger):
@@ -38,24 +85,49 @@ def main(logger):
     # multi-promotion from csv-lines
     # logging level ausgabe ueberarbeiten
     #   zip und csv namen immer mit ausgeben
+    migrate_flat_queue()
+    input_seen = None
+
     while True:
         # Process Active / End-PE
-        process_active_pe()
+        if Schedule.is_due("active_pe"):
+            Schedule.done("active_pe", process_active_pe())
 
         # Process Queued Data
-        process_queued()
-
-        # Process Input
-        process_input()
+        if Schedule.is_due("queued"):
+            Schedule.done("queued", process_queued())
+
+        # Process Input, when the probe sees a change or at the latest every
+        # SCHEDULER_MAX_POLL seconds for files left over
+        input_now = input_fingerprint()
+        has_input = input_now != input_seen
+        if has_input or Schedule.is_due("input"):
+            process_input()
+            Schedule.done("input")
+        input_seen = input_now
 
         # Process queued items
         # do_queud
         from sys import argv
 
         if len(argv) > 1 and argv[1] == "once":
+            Lanes.join()
+            while PendingBlobs:
+                sleep(0.1)
             return
+        pending = Lanes.pending()
+        if pending:
+            logger.info(f"Stores with queued pushes: {pending}")
+        Schedule.backoff(active=has_input)
         logger.debug("####################### Sleeping #######################")
-        sleep(90)
+        Schedule.wait()
+
+
+def input_fingerprint(input_dir=BLOB_INPUT_DIR):
+    """
+    Cheap change probe of the input directory, the ETags of its blobs.
+    """
+    return AB.list_blob_etags(name_starts_with=f"{input_dir}/")
 
 
 def extract_file_name_from_path(file_path):
@@ -86,25 +158,324 @@ def match_file(filename, starts=None, ends=None):
     return does_start and does_end
 
 
+def send_to_stores(send_func, store_ids=None, description="Push"):
+    """
+    Queue send_func(store_id) on the lane of every store.
+
+    Stores are pushed concurrently and each store's pushes run in the order
+    they were queued. Failures are logged per store once all stores are done,
+    one failing store does not abort the push to the others. Returns
+    {store_id: Future}.
+    """
+    if store_ids is None:
+        store_ids = get_existing_store_ids()
+    futures = Lanes.submit_to_stores(store_ids, send_func)
+    when_all_done(
+        futures,
+        lambda failures: log_store_failures(failures, store_ids, description),
+    )
+    return futures
+
+
+def send_article_chunks_to_store(store_id, article_chunks):
+    """
+    Send pre-serialized article chunks to one store, through the asyncio
+    client when AIMS_SAAS_ASYNC is set.
+    """
+    SaasClient.get_access_token()
+    if not AIMS_SAAS_ASYNC:
+        SaasClient.add_article_chunks(
+            store_code=store_id, article_chunks=article_chunks
+        )
+        return
+    AsyncSaasClient.add_article_chunks(store_id, article_chunks)
+
+
+def plu_column_plan():
+    """
+    Column plan of a PLU file, the columns AIMS stores and PLU_PARSE_FIELDS.
+    """
+    return UploadFormat.column_plan(
+        read_file_to_list("resources/plu_item_headers.csv"), keep=PLU_PARSE_FIELDS
+    )
+
+
+def send_articles_to_store(
+    store_id,
+    articles,
+    force_full=False,
+    window_articles=AIMS_SAAS_STREAM_WINDOW_ARTICLES,
+    windows_in_flight=AIMS_SAAS_STREAM_WINDOWS_IN_FLIGHT,
+):
+    """
+    Send the articles that changed since AIMS last accepted them for the store.
+
+    articles can be any iterable, e.g. a generator streaming a file. It is
+    consumed in windows of window_articles articles, their data fields AIMS
+    does not store are dropped and the windows are uploaded in order while
+    the next ones are read. Reading pauses while windows_in_flight windows
+    wait for their upload, so memory is bounded by a few windows whatever
+    the file size. Sends synchronously, callers run it on the store's lane.
+    Returns the number of articles sent.
+    """
+
+    def send_window(window):
+        hashes = ArticleCache.hash_articles(window)
+        indices = ArticleCache.changed_indices(store_id, window, hashes, force_full)
+        if indices:
+            changed = [window[index] for index in indices]
+            SaasClient.get_access_token()
+            SaasClient.add_articles(store_code=store_id, articles=changed)
+            ArticleCache.record(store_id, changed, [hashes[index] for index in indices])
+        return len(window), len(indices)
+
+    counts = drain_in_order(
+        map(UploadFormat.project_articles, iter_batches(articles, window_articles)),
+        send_window,
+        in_flight=windows_in_flight,
+        name=f"upload-{store_id}",
+    )
+    total = sum(read for read, _ in counts)
+    sent = sum(sent for _, sent in counts)
+    if sent < total:
+        logger.info(
+            f"Store {store_id}: {total - sent}/{total} articles unchanged, skipping them"
+        )
+    return sent
+
+
+def send_articles_to_stores(
+    articles, store_ids=None, description="Push", force_full=False
+):
+    """
+    Queue a push of the articles that changed for each store on its lane.
+
+    The changed articles are selected when the store's turn comes, after its
+    earlier pushes were recorded. Stores with the same set of changed
+    articles share one serialization, usually that is all of them. Data
+    fields AIMS does not store are dropped once for all stores. Returns
+    {store_id: Future}.
+    """
+    if store_ids is None:
+        store_ids = get_existing_store_ids()
+    articles = UploadFormat.project_articles(articles)
+    hashes = ArticleCache.hash_articles(articles)
+    serialized = {}
+    serialize_lock = threading.Lock()
+
+    def send(store_id):
+        indices = tuple(
+            ArticleCache.changed_indices(store_id, articles, hashes, force_full)
+        )
+        if not indices:
+            logger.debug(f"{description} unchanged for store {store_id}, skipping")
+            return
+        with serialize_lock:
+            if indices not in serialized:
+                serialized[indices] = SaasClient.serialize_articles(
+                    [articles[index] for index in indices]
+                )
+        send_article_chunks_to_store(store_id, serialized[indices])
+        ArticleCache.record(
+            store_id,
+            [articles[index] for index in indices],
+            [hashes[index] for index in indices],
+        )
+
+    return send_to_stores(send, store_ids=store_ids, description=description)
+
+
+def finish_when_done(blob_name, futures, finish):
+    """
+    Call finish(failures) once all pushes queued for blob_name are done. Until
+    then, and until the Future finish may return is done, the blob is pending
+    and skipped by the processing loops.
+    """
+    PendingBlobs.add(blob_name)
+
+    def done(failures):
+        finishing = None
+        try:
+            finishing = finish(failures)
+        finally:
+            if isinstance(finishing, Future):
+                finishing.add_done_callback(finished)
+            else:
+                PendingBlobs.discard(blob_name)
+
+    def finished(finishing):
+        if finishing.exception() is not None:
+            logger.error(f"Finishing {blob_name} failed: {finishing.exception()}")
+        PendingBlobs.discard(blob_name)
+
+    when_all_done(futures, done)
+
+
+def log_store_failures(failures, store_ids, description="Push"):
+    for store_id, error in failures.items():
+        logger.error(f"{description} failed for store {store_id}: {error}")
+    logger.info(
+        f"{description} sent to {len(store_ids) - len(failures)}/{len(store_ids)} stores"
+    )
+
+
+def blob_source_hash(blob_name):
+    """
+    Return the CSV hash part of a "{iso}|{hash}|{name}" queue/active blob name.
+    """
+    return blob_name.rsplit("/", maxsplit=1)[-1].split("|")[1]
+
+
+def store_sidecar(blob_name, sidecar_data):
+    """
+    Store encoded pre-parsed articles next to a queued or active blob. The
+    sidecar is an optimisation only, failing to write it is logged and ignored.
+    """
+    try:
+        AB.get_blob(sidecar_blob_name(blob_name)).upload_blob(
+            sidecar_data, overwrite=True
+        )
+    except azure_exceptions.AzureError as e:
+        logger.error(f"Could not store sidecar for {blob_name}: {e}")
+
+
+def load_sidecar(blob_name, kind):
+    """
+    Return the pre-parsed payload of a blob, or None if there is no current
+    sidecar for exactly this blob.
+    """
+    try:
+        data = AB.get_blob(sidecar_blob_name(blob_name)).download_blob().readall()
+    except azure_exceptions.ResourceNotFoundError:
+        return None
+    try:
+        payload = decode_sidecar(data)
+    except SidecarError as e:
+        logger.info(f"Stale sidecar for {blob_name} ({e}), parsing the CSV")
+        return None
+    if payload.get("kind") != kind or payload.get("source_hash") != blob_source_hash(
+        blob_name
+    ):
+        logger.info(f"Sidecar for {blob_name} does not match, parsing the CSV")
+        return None
+    compact_articles(payload["articles"])
+    return payload
+
+
+def delete_sidecar(blob_name):
+    """
+    Queue the sidecar of blob_name for the next batch delete, a missing
+    sidecar counts as deleted.
+    """
+    return AB.delete_later(sidecar_blob_name(blob_name))
+
+
+# Raised while a zip member is decompressed, a CRC mismatch is raised by
+# ZipFile once the member is read to its end. Members are decompressed
+# completely into a temporary file before anything is queued or sent, other
+# members are never read.
+ZIP_MEMBER_ERRORS = (BadZipFile, zlib.error, EOFError)
+
+
+def process_sd_zip_members(zip, zipped_files, queue_dir=BLOB_QUEUE_DIR):
+    """
+    Queue the PLU files of an SD zip on the lanes of their stores.
+
+    The members are copied to temporary files here, in zip order, so the
+    zip is read front to back once. A store's files are processed in zip
+    order and the first failing one skips the later files of that store,
+    different stores run in parallel. Returns {member name: Future}, a
+    failed or skipped member's Future holds the exception.
+    """
+    futures = {}
+    failed_stores = {}
+
+    def process_member(zipped_csv_file, store_id_str, tmp_file):
+        with tmp_file:
+            if store_id_str in failed_stores:
+                logger.error(
+                    f"Skipping {zipped_csv_file}, {failed_stores[store_id_str]} of store {store_id_str} failed"
+                )
+                raise RuntimeError(f"{failed_stores[store_id_str]} of the store failed")
+            logger.debug(f"Processing PLU file {zipped_csv_file}")
+            try:
+                process_plu_csv(tmp_file, zipped_csv_file, queue_dir)
+            except Exception:
+                failed_stores[store_id_str] = zipped_csv_file
+                raise
+
+    for zipped_csv_file in zipped_files:
+        tmp_file = TemporaryFile()
+        try:
+            with zip.open(zipped_csv_file, "r") as f:
+                header_line = f.readline()
+                store_id_str, _, _ = sduk_csv_sd_parse_header(header_line.strip())
+                tmp_file.write(header_line)
+                shutil.copyfileobj(f, tmp_file)
+            tmp_file.seek(0)
+        except Exception as e:
+            tmp_file.close()
+            futures[zipped_csv_file] = Future()
+            futures[zipped_csv_file].set_exception(e)
+            continue
+        futures[zipped_csv_file] = Lanes.submit(
+            store_id_str, process_member, zipped_csv_file, store_id_str, tmp_file
+        )
+    return futures
+
+
 def process_input(
     input_dir=BLOB_INPUT_DIR,
     archive_dir=BLOB_ARCHIVE_DIR,
     queue_dir=BLOB_QUEUE_DIR,
     reject_dir=BLOB_REJECT_DIR,
 ):
-    input_files = AB.list_blobs(name_starts_with=f"{input_dir}/")
+    input_sizes = AB.list_blobs_with_properties(name_starts_with=f"{input_dir}/")
 
-    input_files = [input_file for input_file in input_files]
-    input_files.sort()
+    input_files = sorted(input_sizes)
 
     if not input_files:
         logger.debug("Nothing to process")
         return
 
+    def move_when_done(
+        input_file, blob_lease, futures, processed, members=False, zip=None
+    ):
+        """
+        Archive or reject input_file once its queued work is done, with
+        members=True failures of the futures (zip members) reject it. The
+        zip read from input_file is closed then.
+        """
+
+        def move(failures):
+            if zip is not None:
+                zip.close()
+            _was_processed = processed
+            if members:
+                for zipped_csv_file, error in failures.items():
+                    logger.error(f"Error in {input_file} - {zipped_csv_file}: {error}")
+                _was_processed = processed and not failures
+            if _was_processed:
+                _move_to = f"{archive_dir}/"
+            else:
+                _move_to = f"{reject_dir}/"
+            return AB.move_blob(
+                src_name=input_file,
+                tgt_name=input_file.replace(f"{input_dir}/", _move_to),
+                src_lease=blob_lease,
+                background=True,
+            )
+
+        finish_when_done(input_file, futures, move)
+
     for input_file in input_files:
-        _was_processed = False
+        if input_file in PendingBlobs:
+            logger.debug(f"{input_file} is still being pushed")
+            continue
         try:
-            blob, blob_lease = AB.get_blob_with_lease(input_file)
+            blob, blob_lease = AB.get_blob_with_lease(
+                input_file, size=input_sizes[input_file]
+            )
         except azure_exceptions.ResourceExistsError:
             logger.error(
                 f"Could not get lease for {input_file}, will wait so that nothing is processed out of order"
@@ -115,27 +486,18 @@ def process_input(
             continue
 
         if is_csv(input_file):
-            _was_processed = True
+            move_when_done(input_file, blob_lease, {}, processed=True)
 
         elif is_zip(input_file):
-            tmp_file = TemporaryFile()
-            blob.download_blob().readinto(tmp_file)
+            # Only the central directory and the members used are fetched
+            blob_file = RangedBlobFile(blob, size=input_sizes[input_file])
 
             try:
-                zip = ZipFile(tmp_file)
+                zip = ZipFile(blob_file)
             except BadZipFile:
-                logger.error(f"{input_file} is not a zip file")
-                tgt_blob = input_file.replace(f"{input_dir}/", f"{reject_dir}/")
-                AB.move_blob(
-                    src_name=input_file, tgt_name=tgt_blob, src_lease=blob_lease
-                )
-                logger.error(f"Moved {input_file} to {tgt_blob}")
+                logger.error(f"{input_file} is not a zip file, rejecting it")
+                move_when_done(input_file, blob_lease, {}, processed=False)
                 continue
-            zip_test = zip.testzip()
-
-            if zip_test:
-                logger.error(f"Error in {input_file} - {zip_test}")
-                # maybe abort here
 
             # Process SD Files
             if match_file(input_file, starts=f"{input_dir}/SD", ends=".zip"):
@@ -144,13 +506,15 @@ def process_input(
                     for name in zip.namelist()
                     if match_file(name, starts="plu", ends=".csv")
                 ]
-
-                # Search for specific CSV files in extracted directory and print the first line
-                for zipped_csv_file in zipped_files:
-                    logger.debug(f"Processing PLU file {zipped_csv_file}")
-                    with zip.open(zipped_csv_file, "r") as f:
-                        process_plu_csv(f, zipped_csv_file, queue_dir)
-                _was_processed = True
+                futures = process_sd_zip_members(zip, zipped_files, queue_dir)
+                move_when_done(
+                    input_file,
+                    blob_lease,
+                    futures,
+                    processed=True,
+                    members=True,
+                    zip=zip,
+                )
 
             # Process PE0033 Files
             elif match_file(input_file, starts=f"{input_dir}/PE", ends=".zip"):
@@ -161,26 +525,33 @@ def process_input(
                 ]
 
                 # Search for specific CSV files in extracted directory and print the first line
-                for zipped_csv_file in zipped_files:
-                    logger.debug(f"Processing PE file {zipped_csv_file}")
-                    with zip.open(zipped_csv_file) as f:
-                        process_pe0033_csv(
-                            f=f,
-                            pe_filename=zipped_csv_file,
-                            queue_dir=queue_dir,
-                            extra_data={"pe0033_csv_filename": zipped_csv_file},
-                        )
-                _was_processed = True
-
-        if _was_processed:
-            _move_to = f"{archive_dir}/"
+                futures = []
+                try:
+                    for zipped_csv_file in zipped_files:
+                        logger.debug(f"Processing PE file {zipped_csv_file}")
+                        with zip.open(zipped_csv_file) as f:
+                            futures.extend(
+                                process_pe0033_csv(
+                                    f=f,
+                                    pe_filename=zipped_csv_file,
+                                    queue_dir=queue_dir,
+                                    extra_data={"pe0033_csv_filename": zipped_csv_file},
+                                ).values()
+                            )
+                    _was_processed = True
+                except ZIP_MEMBER_ERRORS as e:
+                    logger.error(f"Error in {input_file} - {zipped_csv_file}: {e}")
+                    _was_processed = False
+                # Store push failures are logged by the push, not rejected
+                move_when_done(input_file, blob_lease, futures, _was_processed, zip=zip)
+
+            else:
+                move_when_done(input_file, blob_lease, {}, processed=False, zip=zip)
+
+            logger.info(f"{input_file}: {blob_file.stats()}")
+
         else:
-            _move_to = f"{reject_dir}/"
-        AB.move_blob(
-            src_name=input_file,
-            tgt_name=input_file.replace(f"{input_dir}/", _move_to),
-            src_lease=blob_lease,
-        )
+            move_when_done(input_file, blob_lease, {}, processed=False)
 
 
 def process_pe0033_csv(
@@ -190,6 +561,8 @@ def process_pe0033_csv(
     active_dir=BLOB_ACTIVE_DIR,
     article_filter=False,
     extra_data={},
+    csv_articles=None,
+    store_ids=None,
 ):
     assert f is not None
     assert pe_filename is not None
@@ -213,7 +586,7 @@ def process_pe0033_csv(
     #         days=randrange(1, 14), hours=randrange(-13, 13)
     #     )
 
-    start_date_iso, end_date_iso = start_date.isoformat(), end_date.isoformat()
+    end_date_iso = end_date.isoformat()
 
     pe_duration = end_date - start_date
     if pe_duration.seconds > 20 * 60 * 60:
@@ -229,41 +602,84 @@ def process_pe0033_csv(
     extra_data["pe_promo_type"] = promo_type
     # Check if the store id is listed
 
+    futures = {}
     if is_in_future(start_date):
         # Queue the Articles
-        blob_name = f"{queue_dir}/{start_date_iso}|{csv_hash.hexdigest()}|{pe_filename}"
+        blob_name = queue_blob_name(
+            start_date, csv_hash.hexdigest(), pe_filename, queue_dir
+        )
         logger.debug(f"Storing {pe_filename} articles in {blob_name}")
         try:
             AB.get_blob(blob_name).upload_blob(csv_data)
+            Schedule.schedule("queued", start_date)
+            store_sidecar(
+                blob_name,
+                encode_sidecar(
+                    pe0033_sidecar_payload(
+                        csv_hash.hexdigest(),
+                        header_line,
+                        promo_type,
+                        sduk_csv_pe0033_parse_items_into_articles(f),
+                    )
+                ),
+            )
         except azure_exceptions.ResourceExistsError:
             logger.error("Tried to queue identical data.")
     elif is_in_future(end_date):
-        # Send the Articles
-        for store in get_existing_store_ids():
-            send_csv_pe0033_items_to_aims(
-                store,
-                csv_file=f,
-                csv_filename=pe_filename,
-                article_filter=article_filter,
-                extra_data=extra_data,
+        if csv_articles is None:
+            csv_articles = sduk_csv_pe0033_parse_items_into_articles(f)
+        article_ids = [article["articleId"] for article in csv_articles]
+        # Encoded before sending, sending adds extra_data to the articles
+        sidecar_data = encode_sidecar(
+            pe0033_sidecar_payload(
+                csv_hash.hexdigest(), header_line, promo_type, csv_articles
             )
+        )
+
+        # Send the Articles
+        futures = send_csv_pe0033_items_to_stores(
+            store_ids=store_ids,
+            csv_filename=pe_filename,
+            article_filter=article_filter,
+            extra_data=extra_data,
+            csv_articles=csv_articles,
+        )
         blob_name = f"{active_dir}/{end_date_iso}|{csv_hash.hexdigest()}|{pe_filename}"
+        is_stored = False
         for _ in range(10):
             try:
                 AB.get_blob(blob_name).upload_blob(csv_data)
+                is_stored = True
                 break
             except azure_exceptions.ResourceExistsError:
                 logger.error(
                     f"Tried to 'activate' identical data. ({blob_name} already present)"
                 )
+                is_stored = True
                 break
             except azure_exceptions.ServiceResponseError:
                 logger.error(f"Timeout uploading {blob_name}, retrying.")
             logger.error(f"was not able to store {blob_name}")
 
+        if is_stored:
+            store_sidecar(blob_name, sidecar_data)
+            PEIndex.add(blob_name, article_ids, promo_type)
+            Schedule.schedule("active_pe", end_date)
+
     else:
         # Ignore the Articles
         logger.debug("Do nothing")
+    return futures
+
+
+def pe0033_sidecar_payload(source_hash, header_line, promo_type, csv_articles):
+    return {
+        "kind": "pe0033",
+        "source_hash": source_hash,
+        "header_line": decode_text(header_line),
+        "promo_type": promo_type,
+        "articles": csv_articles,
+    }
 
 
 def reprocess_pe0033_csv(
@@ -271,12 +687,18 @@ def reprocess_pe0033_csv(
     pe_filename=None,
     article_filter=False,
     extra_data={},
+    sidecar=None,
 ):
-    assert f is not None
+    assert f is not None or sidecar is not None
     assert pe_filename is not None
 
-    header_line = f.readline().strip()
-    f.seek(0)
+    if sidecar is not None:
+        header_line = sidecar["header_line"].encode(CSV_ENCODING)
+        csv_articles = sidecar["articles"]
+    else:
+        header_line = f.readline().strip()
+        f.seek(0)
+        csv_articles = None
 
     start_date, end_date, promo_type = sduk_csv_pe_parse_header(header_line)
 
@@ -295,14 +717,13 @@ def reprocess_pe0033_csv(
     # Check if the store id is listed
 
     # Send the Articles
-    for store in get_existing_store_ids():
-        send_csv_pe0033_items_to_aims(
-            store,
-            csv_file=f,
-            csv_filename=pe_filename,
-            article_filter=article_filter,
-            extra_data=extra_data,
-        )
+    return send_csv_pe0033_items_to_stores(
+        csv_file=f,
+        csv_filename=pe_filename,
+        article_filter=article_filter,
+        extra_data=extra_data,
+        csv_articles=csv_articles,
+    )
 
 
 def process_plu_csv(f: bytes = None, plu_filename=None, queue_dir=BLOB_QUEUE_DIR):
@@ -325,13 +746,29 @@ def process_plu_csv(f: bytes = None, plu_filename=None, queue_dir=BLOB_QUEUE_DIR
         f.seek(0)
         csv_data = f.read()
         csv_hash = blake2b(csv_data, digest_size=4)
-        activation_iso = activation_datetime.isoformat()
-        blob_name = (
-            f"{queue_dir}/{activation_iso}|{csv_hash.hexdigest()}|{plu_filename}"
+        blob_name = queue_blob_name(
+            activation_datetime, csv_hash.hexdigest(), plu_filename, queue_dir
         )
         logger.debug(f"Storing {plu_filename} articles in {blob_name}")
         try:
             AB.get_blob(blob_name).upload_blob(csv_data)
+            Schedule.schedule("queued", activation_datetime)
+            f.seek(0)
+            f.readline()
+            store_sidecar(
+                blob_name,
+                encode_sidecar(
+                    {
+                        "kind": "plu",
+                        "source_hash": csv_hash.hexdigest(),
+                        "store_id": store_id_str,
+                        "plu_extra_data": plu_extra_data,
+                        # Not projected, the upload format may change before
+                        # the file is sent, sending projects them then
+                        "articles": sduk_csv_sd_parse_items_into_articles(f),
+                    }
+                ),
+            )
         except azure_exceptions.ResourceExistsError:
             logger.error("Tried to queue identical data.")
     else:
@@ -345,9 +782,11 @@ def process_plu_csv(f: bytes = None, plu_filename=None, queue_dir=BLOB_QUEUE_DIR
 
 
 def strip_empty_fields(dict_to_clean):
+    if isinstance(dict_to_clean, ArticleData):
+        return dict_to_clean.without_empty()
     cleaned_dict = {}
     for key in dict_to_clean.keys():
-        if isinstance(dict_to_clean[key], dict):
+        if isinstance(dict_to_clean[key], Mapping):
             cleaned_dict[key] = strip_empty_fields(dict_to_clean[key])
         elif not isinstance(dict_to_clean[key], str):
             cleaned_dict[key] = dict_to_clean[key]
@@ -357,9 +796,11 @@ def strip_empty_fields(dict_to_clean):
 
 
 def strip_some_empty_fields(dict_to_clean, filter=[]):
+    if isinstance(dict_to_clean, ArticleData):
+        return dict_to_clean.without_empty(filter)
     cleaned_dict = {}
     for key in dict_to_clean.keys():
-        if isinstance(dict_to_clean[key], dict):
+        if isinstance(dict_to_clean[key], Mapping):
             cleaned_dict[key] = strip_some_empty_fields(dict_to_clean[key], filter)
         elif key not in filter:
             cleaned_dict[key] = dict_to_clean[key]
@@ -371,19 +812,38 @@ def strip_some_empty_fields(dict_to_clean, filter=[]):
 
 
 def send_csv_plu_items_to_aims(
-    store_id_str=None, csv_without_header=None, csv_filename=None, extra_data={}
+    store_id_str=None,
+    csv_without_header=None,
+    csv_filename=None,
+    extra_data={},
+    csv_articles=None,
 ):
     assert type(store_id_str) is str
-    assert csv_without_header is not None
+    assert csv_without_header is not None or csv_articles is not None
     assert csv_filename is not None
-    csv_articles = sduk_csv_sd_parse_items_into_articles(csv_without_header)
+    if csv_articles is None:
+        csv_articles = sduk_csv_sd_iter_items_into_articles(
+            csv_without_header, plu_column_plan()
+        )
+
+    counts = {"items": 0}
+    sent = send_articles_to_store(
+        store_id_str, filter_plu_articles(csv_articles, extra_data, counts)
+    )
     logger.info(
-        f"Processed {len(csv_articles)} PLU items for {store_id_str} / {csv_filename}"
+        f"Processed {counts['items']} PLU items for {store_id_str} / {csv_filename}"
     )
+    logger.debug(f"Sent {sent} articles for store {store_id_str} / {csv_filename}")
 
-    articles = []
 
+def filter_plu_articles(csv_articles, extra_data={}, counts=None):
+    """
+    Yield the PLU articles to send by their OP_CODE, enriched with
+    extra_data. counts["items"] counts the articles read.
+    """
     for csv_article in csv_articles:
+        if counts is not None:
+            counts["items"] += 1
         op_code = csv_article.get("data", {}).get("OP_CODE", False)
         if not op_code:
             logger.error("OP_CODE does not exists, this should never happen")
@@ -400,30 +860,26 @@ def send_csv_plu_items_to_aims(
             )
         elif op_code == "5":
             logger.error(
-                f"Unhandled PLU OP_CODE 5 (Sale) {dumps(csv_article)}, stripping empty fields"
+                f"Unhandled PLU OP_CODE 5 (Sale) {dumps(csv_article, default=article_json_default)}, stripping empty fields"
             )
             csv_article = strip_empty_fields(csv_article)
         csv_article["data"].update(extra_data)
-        articles.append(csv_article)
-
-    SaasClient.get_access_token()
-    SaasClient.add_articles(store_code=store_id_str, articles=articles)
-    logger.debug(
-        f"Sent {len(articles)} articles for store {store_id_str} / {csv_filename}"
-    )
+        yield csv_article
 
 
-def send_csv_pe0033_items_to_aims(
-    store_id_str="MASTER",
+def prepare_pe0033_articles(
     csv_file=None,
     csv_filename=None,
     article_filter=False,
     extra_data={},
+    csv_articles=None,
 ):
-    assert csv_file is not None
+    assert csv_file is not None or csv_articles is not None
     assert csv_filename is not None
 
-    if extra_data.get("pe_promo_type", False) == "LOYALTY":
+    if csv_articles is not None:
+        pass
+    elif extra_data.get("pe_promo_type", False) == "LOYALTY":
         csv_articles = sduk_csv_pe0033_parse_items_into_articles(
             # csv_file, header_postfix="__loyalty"
             csv_file
@@ -456,118 +912,312 @@ def send_csv_pe0033_items_to_aims(
         article["data"].update(extra_data)
 
     logger.info(
-        f"Processed {len(csv_articles)} (filtered: {len(articles)}) PE0033 items for {store_id_str}"
+        f"Processed {len(csv_articles)} (filtered: {len(articles)}) PE0033 items from {csv_filename}"
     )
 
     if len(csv_articles) == 0:
         logger.error(f"PE csv without content processed {csv_filename}")
 
-    SaasClient.get_access_token()
-    SaasClient.add_articles(store_code=store_id_str, articles=articles)
-    logger.debug(f"Sent {len(articles)} articles for store {store_id_str}")
+    return articles
 
 
-def process_queued(queue_dir=BLOB_QUEUE_DIR):
-    current = datetime.now(tz=pytz.UTC)
-    logger.debug(f"Processing Queue for NOW: {current.isoformat()}")
+def send_csv_pe0033_items_to_stores(
+    store_ids=None,
+    csv_file=None,
+    csv_filename=None,
+    article_filter=False,
+    extra_data={},
+    csv_articles=None,
+):
+    """
+    Parse, merge and enrich a PE0033 file once and send the same serialized
+    chunks to every store. Already parsed csv_articles skip the parse.
+    """
+    articles = prepare_pe0033_articles(
+        csv_file=csv_file,
+        csv_filename=csv_filename,
+        article_filter=article_filter,
+        extra_data=extra_data,
+        csv_articles=csv_articles,
+    )
 
-    queue_files = AB.list_blobs(name_starts_with=f"{queue_dir}/")
+    return send_articles_to_stores(
+        articles,
+        store_ids=store_ids,
+        description=f"PE0033 {csv_filename} ({len(articles)} articles)",
+    )
 
-    queue_files = [queue_file for queue_file in queue_files]
-    queue_files.sort()
 
-    for file in queue_files:
-        blob_filename = file.replace(f"{queue_dir}/", "")
+def migrate_flat_queue(queue_dir=BLOB_QUEUE_DIR):
+    """
+    Move queue blobs of the old flat "{iso}|{hash}|{name}" layout, and their
+    sidecars, into their due-time bucket. The listing only covers the top
+    level of the queue, buckets are returned as one prefix each.
+    """
+    for file in AB.list_blob_names_in_dir(queue_dir):
         try:
-            file_activation_str, file_hash, file_name = blob_filename.split("|")
-        except Exception as e:
+            due, csv_hash, file_name = parse_queue_blob_name(file)
+        except QueueNameError as e:
             logger.error(e)
-        file_activation = datetime.fromisoformat(file_activation_str)
+            continue
+        try:
+            _, blob_lease = AB.get_blob_with_lease(file)
+        except (azure_exceptions.ResourceExistsError, BlobError) as e:
+            logger.error(f"Could not migrate {file}, retrying on restart: {e}")
+            continue
+        bucketed = queue_blob_name(due, csv_hash, file_name, queue_dir)
+        logger.info(f"Migrating {file} -> {bucketed}")
+        # Sidecar first, a sidecar left behind would never be deleted
+        if AB.get_blob(sidecar_blob_name(file)).exists():
+            AB.move_blob(sidecar_blob_name(file), sidecar_blob_name(bucketed))
+        if not AB.move_blob(file, bucketed, blob_lease):
+            blob_lease.release()
+            logger.error(f"Could not migrate {file}, retrying on restart")
+
+
+def queue_order(blob_name):
+    return parse_queue_blob_name(blob_name)[0], blob_name
+
+
+def waits_for_failed(file, store_id):
+    """
+    Return the failed queued PLU file of store_id that file is due after and
+    has to wait for, or None.
+    """
+    failed = FailedQueuedStores.get(store_id)
+    if failed is None or failed == file or queue_order(file) < queue_order(failed):
+        return None
+    return failed
 
-        if current > file_activation:
-            try:
-                blob, blob_lease = AB.get_blob_with_lease(file)
-            except azure_exceptions.ResourceExistsError:
+
+def send_queued_plu_items(file, store_id, **kwargs):
+    """
+    Send a queued PLU file on its store's lane, unless an earlier queued file
+    of the store failed. A failing file makes the later ones wait for it.
+    """
+    failed = waits_for_failed(file, store_id)
+    if failed is not None:
+        raise RuntimeError(f"{failed} of store {store_id} failed, {file} waits")
+    try:
+        send_csv_plu_items_to_aims(store_id, **kwargs)
+    except Exception:
+        FailedQueuedStores.setdefault(store_id, file)
+        raise
+
+
+def process_queued(queue_dir=BLOB_QUEUE_DIR):
+    """
+    Send the due queued files, return when the next queued file is due.
+    """
+    current = datetime.now(tz=pytz.UTC)
+    logger.debug(f"Processing Queue for NOW: {current.isoformat()}")
+
+    due_files, next_due = due_queue_blobs(
+        AB.iter_blobs_with_properties(name_starts_with=f"{queue_dir}/"),
+        current,
+        queue_dir,
+    )
+    due_sizes = dict(due_files)
+
+    def delete_when_done(file, blob_lease, futures):
+        """
+        Delete file and its sidecar once all its pushes succeeded. After a
+        failure it is kept for the next run, which sends it to the failed
+        stores only.
+        """
+
+        def delete(failures):
+            if failures:
+                log_store_failures(failures, futures, f"Queued {file}")
+                QueuedRetryStores[file] = set(failures)
+                logger.error(f"Keeping {file} to retry {sorted(failures)}")
+                blob_lease.release()
+                return None
+            QueuedRetryStores.pop(file, None)
+            delete_sidecar(file)
+            logger.debug(f"Deleting {file}")
+            return AB.delete_later(file, blob_lease)
+
+        finish_when_done(file, futures, delete)
+
+    def waits(file, store_id):
+        """
+        Return whether file waits for a failed earlier file of store_id that
+        is not retried in this run.
+        """
+        failed = waits_for_failed(file, store_id)
+        if failed is None:
+            return False
+        if failed not in due_sizes:
+            logger.error(f"Failed {failed} of store {store_id} is gone, going on")
+            FailedQueuedStores.pop(store_id, None)
+            return False
+        logger.error(f"Skipped {file}, {failed} of store {store_id} waits for a retry")
+        blocked_stores.add(store_id)
+        return True
+
+    # Stores with a leased PLU file, their later files wait for the next run
+    blocked_stores = set()
+
+    for file in due_sizes:
+        _, _, file_name = parse_queue_blob_name(file)
+
+        if file in PendingBlobs:
+            # Its pushes are queued, later files of the store queue behind them
+            logger.debug(f"{file} is still being pushed")
+            continue
+
+        is_plu = match_file(file_name, starts="plu", ends=".csv")
+        sidecar = load_sidecar(file, "plu") if is_plu else None
+        if sidecar and sidecar["store_id"] in blocked_stores:
+            logger.debug(f"Skipped {file}, an earlier file of the store waits")
+            continue
+        if sidecar and waits(file, sidecar["store_id"]):
+            continue
+        if blocked_stores and not sidecar:
+            logger.error(f"Waiting with {file} until {blocked_stores} can go on")
+            next_due = current
+            break
+        if due_sizes[file] == 0:
+            logger.error(f"{file} - size=0, skipping")
+            continue
+        try:
+            blob, blob_lease = AB.get_blob_with_lease(file, size=due_sizes[file])
+        except azure_exceptions.ResourceExistsError:
+            if sidecar:
                 logger.error(
-                    f"Could not get lease for {file}, will wait so that nothing is processed out of order"
+                    f"Could not get lease for {file}, will wait with store {sidecar['store_id']} so that nothing is processed out of order"
                 )
-                break
-
-            if blob.get_blob_properties().size == 0:
-                logger.error(f"{file} - size=0, skipping")
+                blocked_stores.add(sidecar["store_id"])
+                next_due = current
                 continue
+            logger.error(
+                f"Could not get lease for {file}, will wait so that nothing is processed out of order"
+            )
+            next_due = current
+            break
 
-            was_processed = False
-            if match_file(file_name, starts="plu", ends=".csv"):
-                with TemporaryFile() as tmp_file:
-                    blob.download_blob().readinto(tmp_file)
-                    tmp_file.seek(0)
-                    store_id_str, _, plu_extra_data = sduk_csv_sd_parse_header(
-                        tmp_file.readline().strip()
-                    )
-                    plu_extra_data.update({"plu_csv_filename": file_name})
-                    send_csv_plu_items_to_aims(
-                        store_id_str,
-                        csv_without_header=tmp_file,
-                        csv_filename=file_name,
-                        extra_data=plu_extra_data,
-                    )
-                    was_processed = True
-            elif match_file(file_name, starts="pe0033", ends=".csv"):
-                with TemporaryFile() as tmp_file:
-                    blob.download_blob().readinto(tmp_file)
-                    tmp_file.seek(0)
-                    process_pe0033_csv(
-                        tmp_file,
-                        pe_filename=file_name,
-                        extra_data={"pe0033_csv_filename": file_name},
-                    )
-                    was_processed = True
-            if was_processed:
-                blob.delete_blob(lease=blob_lease)
-                logger.debug(f"Deleted {file}")
-            else:
+        if is_plu and sidecar:
+            store_id_str = sidecar["store_id"]
+            if FailedQueuedStores.get(store_id_str) == file:
+                # Retried now, the later files queue behind it again
+                del FailedQueuedStores[store_id_str]
+            sidecar["plu_extra_data"].update({"plu_csv_filename": file_name})
+            future = Lanes.submit(
+                store_id_str,
+                send_queued_plu_items,
+                file,
+                store_id_str,
+                csv_filename=file_name,
+                extra_data=sidecar["plu_extra_data"],
+                csv_articles=sidecar["articles"],
+            )
+            delete_when_done(file, blob_lease, {store_id_str: future})
+        elif is_plu:
+            # Streamed from the temporary file on the store's lane
+            tmp_file = TemporaryFile()
+            try:
+                blob.download_blob().readinto(tmp_file)
+                tmp_file.seek(0)
+                store_id_str, _, plu_extra_data = sduk_csv_sd_parse_header(
+                    tmp_file.readline().strip()
+                )
+            except Exception:
+                tmp_file.close()
+                raise
+            if waits(file, store_id_str):
+                tmp_file.close()
                 blob_lease.release()
-                logger.error(f"Processing of {file_name} failed")
-                # ToDo, maybe move blob into queue_error folder or something.
-
+                continue
+            if FailedQueuedStores.get(store_id_str) == file:
+                del FailedQueuedStores[store_id_str]
+            plu_extra_data.update({"plu_csv_filename": file_name})
+            future = Lanes.submit(
+                store_id_str,
+                send_queued_plu_items,
+                file,
+                store_id_str,
+                csv_without_header=tmp_file,
+                csv_filename=file_name,
+                extra_data=plu_extra_data,
+            )
+            future.add_done_callback(lambda _, tmp_file=tmp_file: tmp_file.close())
+            delete_when_done(file, blob_lease, {store_id_str: future})
+        elif match_file(file_name, starts="pe0033", ends=".csv"):
+            sidecar = load_sidecar(file, "pe0033")
+            with TemporaryFile() as tmp_file:
+                # The CSV itself is still needed for the active copy
+                blob.download_blob().readinto(tmp_file)
+                tmp_file.seek(0)
+                futures = process_pe0033_csv(
+                    tmp_file,
+                    pe_filename=file_name,
+                    extra_data={"pe0033_csv_filename": file_name},
+                    csv_articles=sidecar["articles"] if sidecar else None,
+                    store_ids=QueuedRetryStores.get(file),
+                )
+            delete_when_done(file, blob_lease, futures)
         else:
-            logger.debug(f"Skipped sending {file}, the time has not yet come.")
+            blob_lease.release()
+            logger.error(f"Processing of {file_name} failed")
+            # ToDo, maybe move blob into queue_error folder or something.
+
+    return next_due
+
+
+def read_pe0033_article_ids(f=None):
+    assert f is not None
+
+    _, _, promo_type = sduk_csv_pe_parse_header(f.readline().strip())
+    header_line = f.readline().strip()
+
+    articles = {}
+    for line in f:
+        article_id = decode_text(line.split(b",", maxsplit=1)[0])
+        if article_id == "=ROW()":
+            continue
+        articles[article_id] = None
+
+    return list(articles), promo_type
 
 
 def get_articles_in_pe0033(blob_name=None):
     assert blob_name is not None
 
-    articles = []
-
     try:
         blob = AB.get_blob(blob_name)
     except azure_exceptions.ResourceExistsError:
         logger.error(f"Could not get lease for {blob_name}")
+    sidecar = load_sidecar(blob_name, "pe0033")
+    if sidecar:
+        articles = [article["articleId"] for article in sidecar["articles"]]
+        return articles, blob, sidecar["promo_type"]
     with TemporaryFile() as tmp_file:
         blob.download_blob().readinto(tmp_file)
         tmp_file.seek(0)
-        _, _, promo_type = sduk_csv_pe_parse_header(tmp_file.readline().strip())
-        header_line = tmp_file.readline().strip()
-
-        for line in tmp_file.readlines():
-            article_id = decode_text(line.split(b",", maxsplit=1)[0])
-            if article_id == "=ROW()":
-                continue
-            if article_id not in articles:
-                articles.append(article_id)
+        articles, promo_type = read_pe0033_article_ids(tmp_file)
 
     return articles, blob, promo_type
 
 
+def load_pe0033_index_entry(blob_name=None):
+    articles, _, promo_type = get_articles_in_pe0033(blob_name=blob_name)
+    return articles, promo_type
+
+
 def process_active_pe(active_dir=BLOB_ACTIVE_DIR):
+    """
+    Deactivate the ended PE files, return when the next active one ends.
+    """
     current = datetime.now(tz=pytz.UTC)
     logger.debug(f"Processing Queue for NOW: {current.isoformat()}")
-    active_files = AB.list_blobs(name_starts_with=f"{active_dir}/")
+    active_sizes = AB.list_blobs_with_properties(name_starts_with=f"{active_dir}/")
+    active_files = list(active_sizes)
 
     def group_files_by_time():
         files_to_deactivate = []
         files_still_active = []
+        next_end = None
 
         for file in active_files:
             blob_filename = file.replace(f"{active_dir}/", "")
@@ -578,41 +1228,43 @@ def process_active_pe(active_dir=BLOB_ACTIVE_DIR):
                     files_to_deactivate.append(file)
                 else:
                     files_still_active.append(file)
+                    if next_end is None or file_enddate < next_end:
+                        next_end = file_enddate
 
         files_to_deactivate.sort()
         files_still_active.sort()
-        return files_to_deactivate, files_still_active
+        return files_to_deactivate, files_still_active, next_end
 
-    files_to_deactivate, files_still_active = group_files_by_time()
+    files_to_deactivate, files_still_active, next_end = group_files_by_time()
 
     logger.debug(f"PE files to deactivate: {files_to_deactivate}")
     logger.debug(f"still active PE files:  {files_still_active}")
 
+    PEIndex.sync(files_to_deactivate + files_still_active, load=load_pe0033_index_entry)
+
     for file in files_to_deactivate:
+        if file in PendingBlobs:
+            logger.debug(f"{file} is still being deactivated")
+            continue
+        if active_sizes[file] == 0:
+            logger.error(f"{file} - size=0, skipping")
+            continue
         try:
-            blob, blob_lease = AB.get_blob_with_lease(file)
+            blob, blob_lease = AB.get_blob_with_lease(file, size=active_sizes[file])
         except azure_exceptions.ResourceExistsError:
             logger.error(
                 f"Could not get lease for {file}, will wait so that nothing is processed out of order"
             )
+            next_end = current
             break
 
-        if blob.get_blob_properties().size == 0:
-            logger.error(f"{file} - size=0, skipping")
-            continue
+        articles_to_check, promo_type = PEIndex.get(file)
 
-        articles_to_check, _, promo_type = get_articles_in_pe0033(blob_name=file)
-
-        fileblobs_to_reprocess = set()
-        found_articles = set()
-        for active_file in files_still_active:
-            active_file_articles, active_file_blob, _ = get_articles_in_pe0033(
-                blob_name=active_file
-            )
-            for article in articles_to_check:
-                if article in active_file_articles:
-                    fileblobs_to_reprocess.add((active_file, active_file_blob))
-                    found_articles.add(article)
+        overlaps = PEIndex.find_overlaps(articles_to_check, files_still_active)
+        fileblobs_to_reprocess = {
+            (active_file, AB.get_blob(active_file)) for active_file in overlaps
+        }
+        found_articles = set().union(*overlaps.values())
 
         logger.debug(
             f"PE files to reprocess (having one of the articles from the file that ended): {list(map(lambda x: x[0], fileblobs_to_reprocess))}"
@@ -632,32 +1284,74 @@ def process_active_pe(active_dir=BLOB_ACTIVE_DIR):
                 for article in articles_without_active_promotion
             ]
 
+        futures = []
         if articles_no_promo:
-            SaasClient.get_access_token()
-            [
-                SaasClient.add_articles(store_code=store, articles=articles_no_promo)
-                for store in get_existing_store_ids()
-            ]
+            futures.extend(
+                send_articles_to_stores(
+                    articles_no_promo,
+                    description=f"PE0033 deactivation {file}",
+                ).values()
+            )
 
         def reprocess_blobs():
             for blob_path, blob in fileblobs_to_reprocess:
                 blob_filename = blob_path.replace(f"{active_dir}/", "")
-                _, _, file_name = blob_filename.split("|")
+                _, file_hash, file_name = blob_filename.split("|")
+                sidecar = load_sidecar(blob_path, "pe0033")
+                if sidecar:
+                    futures.extend(
+                        reprocess_pe0033_csv(
+                            pe_filename=file_name,
+                            article_filter=found_articles,
+                            extra_data={"pe0033_csv_filename": file_name},
+                            sidecar=sidecar,
+                        ).values()
+                    )
+                    logger.debug(f"Re-Processed {blob_path} from its sidecar")
+                    continue
                 with TemporaryFile() as tmp_file:
                     blob.download_blob().readinto(tmp_file)
                     tmp_file.seek(0)
+                    header_line = tmp_file.readline().strip()
+                    tmp_file.seek(0)
+                    csv_articles = sduk_csv_pe0033_parse_items_into_articles(tmp_file)
+                _, _, promo_type = sduk_csv_pe_parse_header(header_line)
+                sidecar = pe0033_sidecar_payload(
+                    file_hash, header_line, promo_type, csv_articles
+                )
+                # Encoded before reprocessing adds extra_data to the articles
+                sidecar_data = encode_sidecar(sidecar)
+                futures.extend(
                     reprocess_pe0033_csv(
-                        tmp_file,
                         pe_filename=file_name,
                         article_filter=found_articles,
                         extra_data={"pe0033_csv_filename": file_name},
-                    )
-                    logger.debug(f"Re-Processed {blob_path}")
+                        sidecar=sidecar,
+                    ).values()
+                )
+                store_sidecar(blob_path, sidecar_data)
+                logger.debug(f"Re-Processed {blob_path}")
 
         reprocess_blobs()
-        logger.info(f"Deleting successfully deactivated blob: {file}")
-        blob.delete_blob(lease=blob_lease)
-        # ToDo, maybe move blob into queue_error folder or something.
+
+        def delete(failures, file=file, blob_lease=blob_lease):
+            if failures:
+                # Indexed and active still, the next run sends it again, the
+                # stores that got it already have nothing changed to send
+                logger.error(
+                    f"Deactivating {file} failed for {len(failures)} pushes, retrying it next run"
+                )
+                blob_lease.release()
+                return None
+            logger.info(f"Deleting successfully deactivated blob: {file}")
+            delete_sidecar(file)
+            PEIndex.remove(file)
+            # ToDo, maybe move blob into queue_error folder or something.
+            return AB.delete_later(file, blob_lease)
+
+        finish_when_done(file, futures, delete)
+
+    return next_end
 
 
 if __name__ == "__main__":
@@ -0,0 +1,199 @@
+"""
+Decoding benchmark: the per-field path replaced by FileDecoder, a copy of
+the former convert_line_to_dict() calling decode_text() for every field,
+against the production paths on the sample PLU and PE0033 files.
+
+PLU files are parsed by PLUTable.read_batches() into ArticleData, PE0033
+items are read with iter_decoded_rows().
+
+    python -m benchmarks.decode
+    python -m benchmarks.decode --repeat 10 --plu-rows 100000 --pe-rows 20000
+
+Both paths have to give the same rows, this is checked before timing, also
+with PLU rows cut short and with a column plan.
+--plu-rows/--pe-rows add a synthetic file of that many rows to the samples.
+"""
+
+import argparse
+import json
+import logging
+import platform
+import tempfile
+from datetime import timedelta
+from io import BytesIO
+from time import perf_counter
+
+import chardet
+
+from benchmarks.run import prepare_environment
+
+logger = logging.getLogger(__name__)
+
+# PLU files have one header line, PE0033 files a header and a column line
+PLU_HEADER_LINES = 1
+PE_HEADER_LINES = 2
+# Fields of a truncated PLU row, up to INTRNL_ID
+PLU_TRUNCATED_FIELDS = 86
+
+
+def decode_text(byte_array: bytes = None) -> str:
+    assert byte_array is not None
+
+    if len(byte_array) == 0:
+        return ""
+    try:
+        decoded_str = byte_array.decode(encoding="ISO-8859-1")
+    except:
+        detection = chardet.detect(byte_array)
+        logger.error(
+            f"Decoding Failed: {detection['encoding']} with {detection['confidence']}"
+        )
+    return decoded_str
+
+
+def convert_line_to_dict(key_list, line, seperator=b"|"):
+    items = line.strip().split(seperator)
+    items = [decode_text(item.strip()) for item in items]
+    return dict(zip(key_list, items))
+
+
+def per_field_rows(sduk, headers, data, separator):
+    return [
+        convert_line_to_dict(headers, line, seperator=separator.encode())
+        for line in BytesIO(data)
+        if line.strip()
+    ]
+
+
+def plu_table_rows(sduk, headers, data, separator):
+    return [
+        article_data
+        for table in sduk.PLUTable.read_batches(BytesIO(data))
+        for article_data in table.article_data()
+    ]
+
+
+def pe0033_rows(sduk, headers, data, separator):
+    decoder = sduk.FileDecoder(name="PE0033 file")
+    return [
+        dict(zip(headers, row))
+        for row in sduk.iter_decoded_rows(BytesIO(data), separator, decoder)
+        if len(row) > 1 or row[0]
+    ]
+
+
+def truncated_plu_items(items, every=1):
+    """
+    Return items with every every-th row cut to PLU_TRUNCATED_FIELDS fields.
+    """
+    lines = items.split(b"\n")
+    for i in range(0, len(lines), every):
+        lines[i] = b"|".join(lines[i].split(b"|")[:PLU_TRUNCATED_FIELDS])
+    return b"\n".join(lines)
+
+
+def plu_inputs(sduk, gen, rows):
+    headers = sduk.read_file_to_list(filename="resources/plu_item_headers.csv")
+    files = list(gen.sample_plu_files().values())
+    if rows:
+        files.append(gen.synthetic_plu_file("0001", rows, gen.today_utc(), "X.CSV"))
+    items = [data.split(b"\n", PLU_HEADER_LINES)[-1] for data in files]
+    # Rows with fewer fields than headers, all of them and every other one
+    items.append(truncated_plu_items(items[0]))
+    items.append(truncated_plu_items(items[0], every=2))
+    return [(headers, data, "|") for data in items]
+
+
+def check_column_plan(sduk, inputs, column_plan):
+    """
+    Check that PLUTable.article_data() with column_plan keeps the columns
+    of the plan that the per-field rows have.
+    """
+    for headers, data, separator in inputs:
+        expected = [
+            {key: value for key, value in row.items() if key in column_plan.columns}
+            for row in per_field_rows(sduk, headers, data, separator)
+        ]
+        table = sduk.PLUTable.parse(data, headers)
+        if list(map(dict, table.article_data(column_plan))) != expected:
+            raise AssertionError("PLUTable with a column plan gives other rows")
+
+
+def pe0033_inputs(sduk, gen, rows):
+    files = list(gen.sample_pe0033_files().values())
+    if rows:
+        start = gen.today_utc()
+        files.append(
+            gen.synthetic_pe0033_file(1, rows, start, start + timedelta(days=7))
+        )
+    inputs = []
+    for data in files:
+        _, columns, items = data.split(b"\n", PE_HEADER_LINES)
+        headers = [decode_text(column.strip()) for column in columns.split(b",")]
+        inputs.append((headers, items, ","))
+    return inputs
+
+
+def measure(sduk, inputs, parse, times):
+    """
+    Return the sizes of inputs and the seconds of the per-field path and
+    parse over times passes.
+    """
+    rows = fields = 0
+    for headers, data, separator in inputs:
+        expected = per_field_rows(sduk, headers, data, separator)
+        if list(map(dict, parse(sduk, headers, data, separator))) != expected:
+            raise AssertionError(f"{parse.__name__} gives other rows")
+        rows += len(expected)
+        fields += sum(map(len, expected))
+    seconds = {}
+    for name, func in (("per_field", per_field_rows), ("production", parse)):
+        started = perf_counter()
+        for _ in range(times):
+            for headers, data, separator in inputs:
+                func(sduk, headers, data, separator)
+        seconds[name] = round(perf_counter() - started, 3)
+    return {
+        "files": len(inputs),
+        "bytes": sum(len(data) for _, data, _ in inputs),
+        "rows": rows,
+        "fields": fields,
+        "per_field_seconds": seconds["per_field"],
+        f"{parse.__name__}_seconds": seconds["production"],
+        "speedup": round(seconds["per_field"] / max(seconds["production"], 1e-9), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-field vs. production decoding")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--plu-rows", type=int, default=0)
+    parser.add_argument("--pe-rows", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="decode-benchmark-") as workspace:
+        prepare_environment(workspace)
+        from benchmarks import generators as gen
+        from modules.aims_saas.upload_format import ColumnPlan
+        from modules.sduk import sduk
+
+        inputs = plu_inputs(sduk, gen, args.plu_rows)
+        headers = inputs[0][0]
+        # Columns on both sides of the truncation
+        check_column_plan(sduk, inputs, ColumnPlan(headers, set(headers[::3])))
+        result = {
+            "repeat": args.repeat,
+            "plu": measure(sduk, inputs, plu_table_rows, args.repeat),
+            "pe0033": measure(
+                sduk,
+                pe0033_inputs(sduk, gen, args.pe_rows),
+                pe0033_rows,
+                args.repeat,
+            ),
+            "python": platform.python_version(),
+        }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
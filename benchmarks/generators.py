@@ -0,0 +1,174 @@
+"""
+Input data for the benchmarks: the shipped samples with their dates moved
+into the benchmark's time window, and synthetic PLU/PE0033 files of any size
+built from the sample rows as templates.
+"""
+
+import glob
+import os
+import zipfile
+from functools import lru_cache
+from datetime import datetime, timedelta
+from hashlib import blake2b
+from io import BytesIO
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_PLU_DIR = os.path.join(REPO, "scripts", "SD", "zip_contents")
+SAMPLE_PE_DIR = os.path.join(REPO, "docs", "overlap-sample")
+
+PLU_TIMEFORMAT = "%d/%m/%Y %H:%M:%S"
+PE_DATEFORMAT = "%d.%m.%Y"
+
+# Positions in the PLU file header and item lines (resources/*_headers.csv)
+PLU_HEADER_ACTIVATION = 5
+PLU_HEADER_STORE = 6
+PLU_HEADER_FILENAME = 7
+PLU_ITEM_ITM_ID = 2
+PLU_ITEM_INTRNL_ID = 85
+# Positions in the PE0033 file header line
+PE_HEADER_EVENT = 1
+PE_HEADER_START = 4
+PE_HEADER_END = 5
+
+
+def csv_hash(data):
+    return blake2b(data, digest_size=4).hexdigest()
+
+
+def zip_files(files):
+    """
+    Return the bytes of a zip of {member name: bytes}.
+    """
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as zip:
+        for name, data in files.items():
+            zip.writestr(name, data)
+    return buffer.getvalue()
+
+
+@lru_cache
+def sample_plu_files():
+    """
+    Return {file name: bytes} of the sample PLU files.
+    """
+    files = {}
+    for path in sorted(glob.glob(os.path.join(SAMPLE_PLU_DIR, "*.CSV"))):
+        with open(path, "rb") as f:
+            files[os.path.basename(path)] = f.read()
+    return files
+
+
+@lru_cache
+def sample_pe0033_files():
+    """
+    Return {file name: bytes} of the PE0033 files of the overlap sample zip.
+    """
+    with zipfile.ZipFile(os.path.join(SAMPLE_PE_DIR, "PE2403251602.zip")) as zip:
+        return {name: zip.read(name) for name in sorted(zip.namelist())}
+
+
+def set_plu_header(data, activation=None, store_id=None, filename=None):
+    header, _, items = data.partition(b"\n")
+    fields = header.rstrip(b"\r").split(b"|")
+    if activation is not None:
+        fields[PLU_HEADER_ACTIVATION] = activation.strftime(PLU_TIMEFORMAT).encode()
+    if store_id is not None:
+        fields[PLU_HEADER_STORE] = store_id.encode()
+    if filename is not None:
+        fields[PLU_HEADER_FILENAME] = filename.encode()
+    return b"|".join(fields) + b"\n" + items
+
+
+def set_pe0033_dates(data, start, end):
+    header, _, rest = data.partition(b"\n")
+    fields = header.split(b",")
+    fields[PE_HEADER_START] = start.strftime(PE_DATEFORMAT).encode()
+    fields[PE_HEADER_END] = end.strftime(PE_DATEFORMAT).encode()
+    return b",".join(fields) + b"\n" + rest
+
+
+def count_rows(data, header_lines):
+    return max(0, data.count(b"\n") + (not data.endswith(b"\n")) - header_lines)
+
+
+@lru_cache
+def _plu_templates():
+    templates = []
+    for data in sample_plu_files().values():
+        templates.extend(
+            line.rstrip(b"\r").split(b"|") for line in data.splitlines()[1:] if line
+        )
+    return templates
+
+
+@lru_cache
+def _pe0033_template():
+    """
+    Return the header line, the column line and the item rows of the
+    smallest sample PE0033 file.
+    """
+    files = sample_pe0033_files()
+    data = min(files.values(), key=len)
+    lines = data.splitlines()
+    return lines[0], lines[1], [line.split(b",") for line in lines[2:] if line]
+
+
+def synthetic_plu_file(store_id, rows, activation, filename, first_id=0):
+    """
+    Return a PLU file of rows items for store_id, item ids first_id.. are
+    unique per file.
+    """
+    templates = _plu_templates()
+    sample = next(iter(sample_plu_files().values()))
+    header = set_plu_header(
+        sample.split(b"\n", 1)[0] + b"\n",
+        activation=activation,
+        store_id=store_id,
+        filename=filename,
+    )
+    lines = [header.rstrip(b"\n")]
+    for row in range(rows):
+        fields = list(templates[row % len(templates)])
+        item_id = f"{first_id + row + 1:013d}".encode()
+        fields[PLU_ITEM_ITM_ID] = item_id
+        fields[PLU_ITEM_INTRNL_ID] = item_id
+        lines.append(b"|".join(fields))
+    return b"\n".join(lines) + b"\n"
+
+
+def synthetic_pe0033_file(event_no, rows, start, end, first_id=0):
+    """
+    Return a PE0033 file of rows promotions on the item ids first_id..
+    """
+    header, columns, templates = _pe0033_template()
+    fields = header.split(b",")
+    fields[PE_HEADER_EVENT] = str(event_no).encode()
+    header = set_pe0033_dates(b",".join(fields), start, end).rstrip(b"\n")
+    lines = [header, columns]
+    for row in range(rows):
+        fields = list(templates[row % len(templates)])
+        fields[0] = str(first_id + row + 1).encode()
+        lines.append(b",".join(fields))
+    return b"\n".join(lines) + b"\n"
+
+
+def pe0033_filename(event_no, now):
+    return f"PE0033_PR_TST_Small_POS(Event_No_{event_no})_{now:%d%m%y%H%M}.csv"
+
+
+def synthetic_store_ids(stores):
+    return [f"{store:04d}" for store in range(1, stores + 1)]
+
+
+def today_utc():
+    now = datetime.utcnow()
+    return datetime(now.year, now.month, now.day)
+
+
+def window():
+    """
+    Return (yesterday, next week) as naive dates, PE0033 files between them
+    are active, ones ending yesterday are due for deactivation.
+    """
+    today = today_utc()
+    return today - timedelta(days=1), today + timedelta(days=7)
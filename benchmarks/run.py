@@ -0,0 +1,420 @@
+"""
+End-to-end benchmarks of process_input, process_queued and process_active_pe
+on the local storage backend against a fake AIMS server.
+
+    python -m benchmarks.run                  # default scenarios vs. baselines
+    python -m benchmarks.run --scenario synthetic --plu-rows 1000000 --stores 1000
+    python -m benchmarks.run --latency 0.05 --error-rate 0.01
+    python -m benchmarks.run --data-fields fields.txt  # AIMS stores only these
+    python -m benchmarks.run --save-baseline
+
+Every scenario runs in its own process and workspace, so its peak RSS is its
+own. Results are compared with benchmarks/baselines/<scenario>.json, a
+throughput drop or memory growth beyond --tolerance is reported as a
+regression and fails the run.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+from datetime import timedelta
+from time import perf_counter, sleep
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_DIR = os.path.join(REPO, "benchmarks", "baselines")
+
+SCENARIOS = {
+    # The shipped PLU and PE0033 samples
+    "samples": {"stores": 10, "plu_rows": 0, "pe_files": 0, "pe_rows": 0},
+    "synthetic-small": {
+        "stores": 20,
+        "plu_rows": 20000,
+        "pe_files": 4,
+        "pe_rows": 2000,
+    },
+    # Full scale, only run when asked for
+    "synthetic": {
+        "stores": 1000,
+        "plu_rows": 1000000,
+        "pe_files": 4,
+        "pe_rows": 100,
+    },
+}
+DEFAULT_SCENARIOS = ["samples", "synthetic-small"]
+STAGES = ["process_input", "process_queued", "process_active_pe"]
+# Share of the PLU rows arriving as input, the rest is already queued
+INPUT_PLU_SHARE = 0.8
+
+
+def prepare_environment(workspace):
+    """
+    Point the adapter at the workspace before anything imports env.py.
+    """
+    shutil.copytree(
+        os.path.join(REPO, "resources"), os.path.join(workspace, "resources")
+    )
+    os.environ.update(
+        {
+            "STORAGE_BACKEND": "local",
+            "LOCAL_STORAGE_PATH": os.path.join(workspace, "data"),
+            "ARTICLE_CACHE_PATH": os.path.join(workspace, "cache", "articles.db"),
+            "ACTIVE_PE_INDEX_PATH": os.path.join(workspace, "cache", "pe_index.db"),
+            "AIMS_SAAS_USERNAME": "benchmark",
+            "AIMS_SAAS_PASSWORD": "benchmark",
+            "LOG_LEVEL": os.environ.get("LOG_LEVEL", "ERROR"),
+        }
+    )
+    os.chdir(workspace)
+    if REPO not in sys.path:
+        sys.path.insert(0, REPO)
+
+
+def build_samples(app, gen, params):
+    """
+    Return [(blob name, bytes, rows)] from the shipped samples: the PLU files
+    as an SD zip and as queued files, the PE0033 zip as input and its files
+    split into ended and still active ones.
+    """
+    yesterday, next_week = gen.window()
+    blobs = []
+    plu_files = gen.sample_plu_files()
+    pe_files = {
+        name: gen.set_pe0033_dates(data, yesterday, next_week)
+        for name, data in gen.sample_pe0033_files().items()
+    }
+    blobs.append(
+        (
+            "input/SD_samples.zip",
+            gen.zip_files(plu_files),
+            sum(gen.count_rows(data, 1) for data in plu_files.values()),
+        )
+    )
+    blobs.append(
+        (
+            "input/PE_samples.zip",
+            gen.zip_files(pe_files),
+            sum(gen.count_rows(data, 2) for data in pe_files.values()),
+        )
+    )
+    # Activated a week ago, other content than the input copies
+    for name, data in plu_files.items():
+        data = gen.set_plu_header(data, activation=yesterday - timedelta(days=6))
+        blobs.append(queued_plu(app, gen, name, data))
+    last_week = yesterday - timedelta(days=7)
+    for index, (name, data) in enumerate(sorted(pe_files.items(), key=by_size)):
+        end = yesterday if index % 2 == 0 else next_week + timedelta(days=1)
+        data = gen.set_pe0033_dates(data, last_week, end)
+        blobs.append(active_pe0033(app, gen, name, data))
+    return blobs
+
+
+def build_synthetic(app, gen, params):
+    """
+    Return [(blob name, bytes, rows)] of synthetic files: one PLU file per
+    store in an SD zip and in the queue, PE0033 files as input, queued, and
+    ended or still active ones sharing half of their items.
+    """
+    yesterday, next_week = gen.window()
+    last_week = yesterday - timedelta(days=7)
+    stores = gen.synthetic_store_ids(params["stores"])
+    input_rows = int(params["plu_rows"] * INPUT_PLU_SHARE) // len(stores)
+    queued_rows = (params["plu_rows"] - input_rows * len(stores)) // len(stores)
+    blobs = []
+
+    sd_files = {}
+    for store_id in stores:
+        name = f"PLU{store_id}1.CSV"
+        sd_files[name] = gen.synthetic_plu_file(store_id, input_rows, last_week, name)
+    blobs.append(
+        ("input/SD_synthetic.zip", gen.zip_files(sd_files), input_rows * len(stores))
+    )
+    for store_id in stores:
+        name = f"PLU{store_id}2.CSV"
+        data = gen.synthetic_plu_file(
+            store_id, queued_rows, last_week, name, first_id=input_rows
+        )
+        blobs.append(queued_plu(app, gen, name, data))
+
+    pe_rows = params["pe_rows"]
+    now = gen.today_utc()
+    pe_files = {}
+    for event in range(params["pe_files"]):
+        pe_files[gen.pe0033_filename(10000 + event, now)] = gen.synthetic_pe0033_file(
+            10000 + event, pe_rows, yesterday, next_week, first_id=event * pe_rows
+        )
+    blobs.append(
+        ("input/PE_synthetic.zip", gen.zip_files(pe_files), pe_rows * len(pe_files))
+    )
+    for event in range(params["pe_files"] // 2):
+        data = gen.synthetic_pe0033_file(
+            20000 + event, pe_rows, yesterday, next_week, first_id=event * pe_rows
+        )
+        blobs.append(
+            queued_pe0033(app, gen, gen.pe0033_filename(20000 + event, now), data)
+        )
+    for event in range(params["pe_files"]):
+        end = yesterday if event % 2 == 0 else next_week
+        data = gen.synthetic_pe0033_file(
+            30000 + event, pe_rows, last_week, end, first_id=event * pe_rows // 2
+        )
+        blobs.append(
+            active_pe0033(app, gen, gen.pe0033_filename(30000 + event, now), data)
+        )
+    return blobs
+
+
+def by_size(item):
+    return len(item[1])
+
+
+def queued_plu(app, gen, name, data):
+    _, activation, _ = app.sduk_csv_sd_parse_header(data.split(b"\n", 1)[0].strip())
+    blob_name = app.queue_blob_name(activation, gen.csv_hash(data), name)
+    return blob_name, data, gen.count_rows(data, 1)
+
+
+def queued_pe0033(app, gen, name, data):
+    start, _, _ = app.sduk_csv_pe_parse_header(data.split(b"\n", 1)[0].strip())
+    blob_name = app.queue_blob_name(start, gen.csv_hash(data), name)
+    return blob_name, data, gen.count_rows(data, 2)
+
+
+def active_pe0033(app, gen, name, data):
+    _, end, _ = app.sduk_csv_pe_parse_header(data.split(b"\n", 1)[0].strip())
+    blob_name = f"active/{end.isoformat()}|{gen.csv_hash(data)}|{name}"
+    return blob_name, data, gen.count_rows(data, 2)
+
+
+def wait_for_pushes(app):
+    app.Lanes.join()
+    while app.PendingBlobs:
+        sleep(0.01)
+
+
+def read_data_fields(path):
+    """
+    Return the data fields of the fake upload format, one per line of path.
+    """
+    if path is None:
+        return []
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def run_scenario(name, params, latency, error_rate, data_fields=()):
+    """
+    Run one scenario in this process, return its metrics.
+    """
+    workspace = tempfile.mkdtemp(prefix=f"sduk-bench-{name}-")
+    try:
+        prepare_environment(workspace)
+        from benchmarks import generators as gen
+
+        stores = gen.synthetic_store_ids(params["stores"])
+        if name == "samples":
+            stores += sorted(
+                {
+                    data.split(b"|")[gen.PLU_HEADER_STORE].decode()
+                    for data in gen.sample_plu_files().values()
+                }
+            )
+        with open(os.path.join(workspace, "resources", "store_ids.csv"), "w") as f:
+            f.write("\n".join(stores) + "\n")
+
+        from modules.aims_saas.fake_aims_server import FakeAIMSServer
+
+        server = FakeAIMSServer(
+            latency=latency, error_rate=error_rate, data_fields=data_fields
+        ).start()
+        os.environ["AIMS_SAAS_URL"] = server.url
+        import app
+
+        app.SaasClient.BASE_URL = server.url
+
+        build = build_samples if name == "samples" else build_synthetic
+        start = perf_counter()
+        blobs = build(app, gen, params)
+        generate_seconds = perf_counter() - start
+        rows = {stage: 0 for stage in STAGES}
+        for blob_name, data, blob_rows in blobs:
+            app.AB.get_blob(blob_name).upload_blob(data, overwrite=True)
+            stage = {"input": "process_input", "queue": "process_queued"}.get(
+                blob_name.split("/", 1)[0], "process_active_pe"
+            )
+            rows[stage] += blob_rows
+        input_bytes = sum(len(data) for _, data, _ in blobs)
+        del blobs
+
+        server.reset_stats()
+        timings = {}
+        articles = {}
+        total_start = perf_counter()
+        for stage in STAGES:
+            before = server.stats["articles"]
+            start = perf_counter()
+            getattr(app, stage)()
+            wait_for_pushes(app)
+            timings[stage] = perf_counter() - start
+            articles[stage] = server.stats["articles"] - before
+        total = perf_counter() - total_start
+        stats = dict(server.stats)
+        server.stop()
+
+        return {
+            "scenario": name,
+            "params": params,
+            "latency": latency,
+            "error_rate": error_rate,
+            "data_fields": len(data_fields),
+            "rows": sum(rows.values()),
+            "rows_per_stage": rows,
+            "input_bytes": input_bytes,
+            "generate_seconds": round(generate_seconds, 3),
+            "seconds": round(total, 3),
+            "stage_seconds": {stage: round(t, 3) for stage, t in timings.items()},
+            "articles_sent": stats["articles"],
+            "articles_per_stage": articles,
+            "requests": stats["requests"],
+            "errors": stats["errors"],
+            "bytes_sent": stats["bytes_received"],
+            "rows_per_second": round(sum(rows.values()) / total, 1),
+            "articles_per_second": round(stats["articles"] / total, 1),
+            # Linux reports KiB
+            "peak_rss_mb": round(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+            ),
+        }
+    finally:
+        os.chdir(REPO)
+        shutil.rmtree(workspace, ignore_errors=True)
+
+
+def compare(result, baseline, tolerance):
+    """
+    Return the regressions of result against baseline.
+    """
+    regressions = []
+    for key in ("rows_per_second", "articles_per_second"):
+        if baseline.get(key) and result[key] < baseline[key] * (1 - tolerance):
+            regressions.append(f"{key} {result[key]} < baseline {baseline[key]}")
+    for key in ("peak_rss_mb", "bytes_sent"):
+        if baseline.get(key) and result[key] > baseline[key] * (1 + tolerance):
+            regressions.append(f"{key} {result[key]} > baseline {baseline[key]}")
+    return regressions
+
+
+def baseline_path(name):
+    return os.path.join(BASELINE_DIR, f"{name}.json")
+
+
+def run_child(name, args):
+    """
+    Run one scenario in a fresh interpreter, return its metrics.
+    """
+    command = [
+        sys.executable,
+        "-m",
+        "benchmarks.run",
+        "--child",
+        "--scenario",
+        name,
+        "--latency",
+        str(args.latency),
+        "--error-rate",
+        str(args.error_rate),
+    ]
+    if args.data_fields is not None:
+        command += ["--data-fields", os.path.abspath(args.data_fields)]
+    for key in ("stores", "plu_rows", "pe_files", "pe_rows"):
+        if getattr(args, key) is not None:
+            command += [f"--{key.replace('_', '-')}", str(getattr(args, key))]
+    output = subprocess.run(
+        command, cwd=REPO, check=True, stdout=subprocess.PIPE, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def scenario_params(name, args):
+    params = dict(SCENARIOS[name])
+    for key in params:
+        if getattr(args, key) is not None:
+            params[key] = getattr(args, key)
+    return params
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+    names = args.scenario or DEFAULT_SCENARIOS
+
+    if args.child:
+        result = run_scenario(
+            names[0],
+            scenario_params(names[0], args),
+            args.latency,
+            args.error_rate,
+            read_data_fields(args.data_fields),
+        )
+        print(json.dumps(result))
+        return
+
+    failed = False
+    for name in names:
+        result = run_child(name, args)
+        result["python"] = platform.python_version()
+        print(json.dumps(result, indent=2))
+        path = baseline_path(name)
+        if args.save_baseline:
+            os.makedirs(BASELINE_DIR, exist_ok=True)
+            with open(path, "w") as f:
+                json.dump(result, f, indent=2)
+                f.write("\n")
+            print(f"Saved baseline {path}")
+            continue
+        if not os.path.exists(path):
+            print(f"No baseline for {name}, run with --save-baseline")
+            continue
+        with open(path) as f:
+            baseline = json.load(f)
+        if (
+            baseline["params"] != result["params"]
+            or baseline["latency"] != result["latency"]
+            or baseline.get("data_fields", 0) != result["data_fields"]
+        ):
+            print(f"Baseline of {name} was recorded with other parameters, skipped")
+            continue
+        regressions = compare(result, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {name}: {regression}")
+        failed = failed or bool(regressions)
+    sys.exit(1 if failed else 0)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Adapter pipeline benchmarks")
+    parser.add_argument(
+        "--scenario", action="append", choices=sorted(SCENARIOS), help="repeatable"
+    )
+    parser.add_argument("--stores", type=int)
+    parser.add_argument("--plu-rows", type=int)
+    parser.add_argument("--pe-files", type=int)
+    parser.add_argument("--pe-rows", type=int)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--data-fields", help="file of the data fields AIMS stores, one per line"
+    )
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    return parser
+
+
+if __name__ == "__main__":
+    main()
@@ -22,11 +22,20 @@ load_dotenv(override=False)
 LOG_LEVEL = getenv(key="LOG_LEVEL", default="WARN").upper()
 LOG_LEVEL_AZURE = getenv(key="LOG_LEVEL_AZURE", default="WARN").upper()
 
+# Blob storage backend, "azure" or "local" (a directory tree, e.g. for on-prem
+# ingest or benchmarks without network latency)
+STORAGE_BACKEND = getenv(key="STORAGE_BACKEND", default="azure").lower()
+LOCAL_STORAGE_PATH = getenv(key="LOCAL_STORAGE_PATH", default="./data")
+
 AZURE_ACCOUNT_NAME = getenv(key="AZURE_ACCOUNT_NAME")
 AZURE_ACCOUNT_KEY = getenv(key="AZURE_ACCOUNT_KEY")
 AZURE_ACCOUNT_CONTAINER = getenv(
     key="AZURE_ACCOUNT_CONTAINER", default="aims-saas-adapter-superdrug-uk-test"
 )
+AZURE_ACCOUNT_URL = getenv(
+    key="AZURE_ACCOUNT_URL",
+    default=f"https://{AZURE_ACCOUNT_NAME}.blob.core.windows.net/",
+)
 
 AIMS_SAAS_URL = getenv(
     key="AIMS_SAAS_URL", default="https://stage00.common.solumesl.com/common"
@@ -37,8 +46,9 @@ AIMS_SAAS_COMPANY = getenv(key="AIMS_SAAS_COMPANY", default="SPD")
 
 
 # Fail if Azure Env is does not exist
-assert AZURE_ACCOUNT_NAME is not None
-assert AZURE_ACCOUNT_KEY is not None
+if STORAGE_BACKEND == "azure":
+    assert AZURE_ACCOUNT_NAME is not None
+    assert AZURE_ACCOUNT_KEY is not None
 # Fail if AIMS SaaS Credentials are not given
 assert AIMS_SAAS_USERNAME is not None
 assert AIMS_SAAS_PASSWORD is not None
@@ -48,13 +58,120 @@ CSV_TZ = getenv(key="CSV_TZ", default=getenv(key="TZ", default="Europe/London"))
 CSV_TIMEFORMAT = getenv(
     key="CSV_TIMEFORMAT", default=getenv(key="TIMEFORMAT", default="%d/%m/%Y %H:%M:%S")
 )
+# Encoding of the PLU and PE0033 feeds, a file that does not decode with it
+# is decoded with the encoding detected for the file
+CSV_ENCODING = getenv(key="CSV_ENCODING", default="ISO-8859-1")
 
 BLOB_QUEUE_DIR = getenv(key="BLOB_QUEUE_DIR", default="queue")
 BLOB_INPUT_DIR = getenv(key="BLOB_INPUT_DIR", default="input")
 BLOB_ARCHIVE_DIR = getenv(key="BLOB_ARCHIVE_DIR", default="archive")
 BLOB_REJECT_DIR = getenv(key="BLOB_REJECT_DIR", default="reject")
 BLOB_ACTIVE_DIR = getenv(key="BLOB_ACTIVE_DIR", default="active")
+BLOB_SIDECAR_DIR = getenv(key="BLOB_SIDECAR_DIR", default="sidecar")
+
+# Archive/reject moves running in the background
+BLOB_MOVE_WORKERS = int(getenv(key="BLOB_MOVE_WORKERS", default="4"))
+
+# Seconds deletes wait to be sent together in one batch request
+BLOB_DELETE_LINGER = float(getenv(key="BLOB_DELETE_LINGER", default="0.5"))
+
+# Read-ahead of range requests when reading zip blobs in place
+BLOB_RANGE_BLOCK_SIZE = int(
+    getenv(key="BLOB_RANGE_BLOCK_SIZE", default=str(256 * 1024))
+)
+
+# Main loop wake-ups: seconds between input probes while busy and at most
+# while idle, queue and active PEs are re-listed at least every max seconds
+SCHEDULER_MIN_POLL = float(getenv(key="SCHEDULER_MIN_POLL", default="5"))
+SCHEDULER_MAX_POLL = float(getenv(key="SCHEDULER_MAX_POLL", default="90"))
 
 TIMEOUT = 30
 
+# AIMS SaaS HTTP connection pool, sized for concurrent store fan-out
+AIMS_SAAS_CONNECT_TIMEOUT = float(getenv(key="AIMS_SAAS_CONNECT_TIMEOUT", default="5"))
+AIMS_SAAS_READ_TIMEOUT = float(
+    getenv(key="AIMS_SAAS_READ_TIMEOUT", default=str(TIMEOUT))
+)
+AIMS_SAAS_POOL_CONNECTIONS = int(getenv(key="AIMS_SAAS_POOL_CONNECTIONS", default="1"))
+AIMS_SAAS_POOL_MAXSIZE = int(getenv(key="AIMS_SAAS_POOL_MAXSIZE", default="16"))
+AIMS_SAAS_MAX_RETRIES = int(getenv(key="AIMS_SAAS_MAX_RETRIES", default="3"))
+
+# Access token renewal, seconds before expiry / fallback lifetime
+AIMS_SAAS_TOKEN_REFRESH_MARGIN = float(
+    getenv(key="AIMS_SAAS_TOKEN_REFRESH_MARGIN", default="120")
+)
+AIMS_SAAS_TOKEN_DEFAULT_TTL = float(
+    getenv(key="AIMS_SAAS_TOKEN_DEFAULT_TTL", default="900")
+)
+AIMS_SAAS_TOKEN_BACKGROUND_REFRESH = strtobool(
+    getenv(key="AIMS_SAAS_TOKEN_BACKGROUND_REFRESH", default="true")
+)
+
+# Article upload bodies: article/byte caps and latency target for adaptation
+AIMS_SAAS_CHUNK_MAX_ARTICLES = int(
+    getenv(key="AIMS_SAAS_CHUNK_MAX_ARTICLES", default="5000")
+)
+AIMS_SAAS_CHUNK_MAX_BYTES = int(
+    getenv(key="AIMS_SAAS_CHUNK_MAX_BYTES", default=str(4 * 1024 * 1024))
+)
+AIMS_SAAS_CHUNK_MIN_BYTES = int(
+    getenv(key="AIMS_SAAS_CHUNK_MIN_BYTES", default=str(256 * 1024))
+)
+AIMS_SAAS_CHUNK_TARGET_SECONDS = float(
+    getenv(key="AIMS_SAAS_CHUNK_TARGET_SECONDS", default="5")
+)
+
+# Streamed PLU sends: input bytes per parse batch, articles per upload window
+# and windows waiting for or in upload before the parse pauses
+PLU_PARSE_BATCH_BYTES = int(
+    getenv(key="PLU_PARSE_BATCH_BYTES", default=str(1024 * 1024))
+)
+AIMS_SAAS_STREAM_WINDOW_ARTICLES = int(
+    getenv(key="AIMS_SAAS_STREAM_WINDOW_ARTICLES", default="5000")
+)
+AIMS_SAAS_STREAM_WINDOWS_IN_FLIGHT = int(
+    getenv(key="AIMS_SAAS_STREAM_WINDOWS_IN_FLIGHT", default="2")
+)
+
+# gzip article upload bodies, falls back to plain JSON if AIMS rejects them
+AIMS_SAAS_GZIP = strtobool(getenv(key="AIMS_SAAS_GZIP", default="true"))
+AIMS_SAAS_GZIP_LEVEL = int(getenv(key="AIMS_SAAS_GZIP_LEVEL", default="5"))
+
+# Drop article data fields that are not in the AIMS article upload format
+AIMS_UPLOAD_FORMAT_PROJECTION = strtobool(
+    getenv(key="AIMS_UPLOAD_FORMAT_PROJECTION", default="true")
+)
+AIMS_UPLOAD_FORMAT_TTL = float(getenv(key="AIMS_UPLOAD_FORMAT_TTL", default="3600"))
+AIMS_UPLOAD_FORMAT_RETRY = float(getenv(key="AIMS_UPLOAD_FORMAT_RETRY", default="300"))
+
+# Per-store hashes of accepted articles, unchanged articles are not re-sent
+ARTICLE_CACHE_ENABLED = strtobool(getenv(key="ARTICLE_CACHE_ENABLED", default="true"))
+ARTICLE_CACHE_PATH = getenv(
+    key="ARTICLE_CACHE_PATH", default="./data/cache/article_cache.sqlite3"
+)
+ARTICLE_CACHE_MAX_ENTRIES = int(
+    getenv(key="ARTICLE_CACHE_MAX_ENTRIES", default="5000000")
+)
+ARTICLE_CACHE_MAX_AGE_DAYS = float(
+    getenv(key="ARTICLE_CACHE_MAX_AGE_DAYS", default="7")
+)
+
+# Local inverted index articleId -> active PE0033 blobs
+ACTIVE_PE_INDEX_PATH = getenv(
+    key="ACTIVE_PE_INDEX_PATH", default="./data/cache/active_pe_index.sqlite3"
+)
+
+# Number of stores an article set is pushed to in parallel
+STORE_FANOUT_WORKERS = int(getenv(key="STORE_FANOUT_WORKERS", default="8"))
+
+# asyncio client: pipelined chunk uploads over one event loop
+AIMS_SAAS_ASYNC = strtobool(getenv(key="AIMS_SAAS_ASYNC", default="false"))
+AIMS_SAAS_HTTP2 = strtobool(getenv(key="AIMS_SAAS_HTTP2", default="true"))
+AIMS_SAAS_ASYNC_MAX_IN_FLIGHT = int(
+    getenv(key="AIMS_SAAS_ASYNC_MAX_IN_FLIGHT", default="32")
+)
+AIMS_SAAS_CHUNKS_IN_FLIGHT_PER_STORE = int(
+    getenv(key="AIMS_SAAS_CHUNKS_IN_FLIGHT_PER_STORE", default="4")
+)
+
 VERIFY_SSL = strtobool(getenv(key="VERIFY_SSL", default="true"))
@@ -1,11 +1,27 @@
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
+from urllib3.util.retry import Retry
 import json
 import os
 from dotenv import load_dotenv
 from modules.sduk.common import set_logger
-from functools import lru_cache
-from time import time
+from modules.aims_saas.token_manager import AIMSSaaSTokenManager
+from modules.aims_saas.article_chunks import (
+    AdaptiveChunkBudget,
+    UploadStats,
+    iter_article_chunks,
+)
+from env import (
+    AIMS_SAAS_CONNECT_TIMEOUT,
+    AIMS_SAAS_READ_TIMEOUT,
+    AIMS_SAAS_POOL_CONNECTIONS,
+    AIMS_SAAS_POOL_MAXSIZE,
+    AIMS_SAAS_MAX_RETRIES,
+    AIMS_SAAS_CHUNK_MAX_ARTICLES,
+    AIMS_SAAS_GZIP,
+    VERIFY_SSL,
+)
 
 logger = set_logger("SaaS Api")
 
@@ -15,104 +31,237 @@ load_dotenv()
 class AIMSSaaSAPIClient:
     BASE_URL = os.getenv("AIMS_SAAS_URL")
 
-    def __init__(self):
+    def __init__(
+        self,
+        pool_connections=AIMS_SAAS_POOL_CONNECTIONS,
+        pool_maxsize=AIMS_SAAS_POOL_MAXSIZE,
+        max_retries=AIMS_SAAS_MAX_RETRIES,
+        timeout=(AIMS_SAAS_CONNECT_TIMEOUT, AIMS_SAAS_READ_TIMEOUT),
+    ):
         self.username = os.getenv("AIMS_SAAS_USERNAME", None)
         self.password = os.getenv("AIMS_SAAS_PASSWORD", None)
-        self.access_token = None
-        self.refresh_token = None
         self.company = os.getenv("AIMS_SAAS_COMPANY", None)
+        self.timeout = timeout
+        self.session = self._create_session(pool_connections, pool_maxsize, max_retries)
+        self.tokens = AIMSSaaSTokenManager(login=self._login, refresh=self._refresh)
+        self.chunk_budget = AdaptiveChunkBudget()
+        self.gzip_uploads = AIMS_SAAS_GZIP
+        self.upload_stats = UploadStats()
+
+    @property
+    def access_token(self):
+        return self.tokens.access_token
+
+    @property
+    def refresh_token(self):
+        return self.tokens.refresh_token
+
+    @staticmethod
+    def _create_session(pool_connections, pool_maxsize, max_retries):
+        """
+        Create a keep-alive session whose connection pool is shared by all calls.
+
+        pool_maxsize bounds the connections kept open per host and should be at
+        least the number of stores pushed concurrently. Only connection errors
+        are retried, a PUT that reached the server is never sent twice.
+        """
+        retries = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=0,
+            status=0,
+            other=0,
+            backoff_factor=0.5,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            max_retries=retries,
+            pool_block=True,
+        )
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.verify = VERIFY_SSL
+        return session
+
+    def close(self):
+        """
+        Close all pooled connections.
+        """
+        self.session.close()
+
+    def get_access_token(self):
+        """
+        Return a valid access token, authenticating or refreshing only when the
+        current token is missing or about to expire.
+        """
+        return self.tokens.get_token()
 
-    @lru_cache(maxsize=2)
-    def get_access_token(self, ttl_func=round(time() / 300)):
-        del ttl_func
+    def _login(self):
         """
         Retrieve the authentication token using the provided username and password.
         """
         endpoint = f"{self.BASE_URL}/api/v2/token"
+        data = {"username": self.username, "password": self.password}
+        return self._post_token_request(endpoint, data)
 
-        headers = {"accept": "application/json", "Content-Type": "application/json"}
+    def _refresh(self, refresh_token):
+        """
+        Retrieve a new authentication token using the refresh token.
+        """
+        endpoint = f"{self.BASE_URL}/api/v2/token/refresh"
+        data = {"refreshToken": refresh_token}
+        return self._post_token_request(endpoint, data)
 
-        data = {"username": self.username, "password": self.password}
+    def _post_token_request(self, endpoint, data):
+        headers = {"accept": "application/json", "Content-Type": "application/json"}
 
-        response = requests.post(endpoint, headers=headers, data=json.dumps(data))
+        response = self.session.post(
+            endpoint, headers=headers, data=json.dumps(data), timeout=self.timeout
+        )
         if response.status_code == 200:
-            self.access_token = response.json()["responseMessage"]["access_token"]
-            self.refresh_token = response.json()["responseMessage"]["refresh_token"]
-            return self.access_token
+            return response.json()["responseMessage"]
         else:
             response.raise_for_status()
 
-    def get_article_upload_format(self):
+    def _request(self, method, endpoint, headers=None, **kwargs):
         """
-        Get article upload format
+        Send an authenticated request, retrying once with a renewed token on 401.
         """
-        if not self.access_token:
-            raise ValueError(
-                "Token not set. Please authenticate before making requests."
+        access_token = self.get_access_token()
+        for attempt in range(2):
+            request_headers = {
+                **(headers or {}),
+                "Authorization": f"Bearer {access_token}",
+            }
+            response = self.session.request(
+                method,
+                endpoint,
+                headers=request_headers,
+                timeout=self.timeout,
+                **kwargs,
             )
+            if response.status_code != 401 or attempt:
+                return response
+            logger.error(f"401 from {endpoint}, renewing access token and retrying")
+            access_token = self.tokens.renew(stale_token=access_token)
 
+    def get_article_upload_format(self):
+        """
+        Get article upload format
+        """
         endpoint = f"{self.BASE_URL}/api/v2/common/articles/upload/format"
         params = {"company": self.company}
 
-        headers = {
-            "accept": "application/json",
-            "Authorization": f"Bearer {self.access_token}",
-        }
+        headers = {"accept": "application/json"}
 
-        response = requests.put(endpoint, headers=headers, params=params)
+        response = self._request("PUT", endpoint, headers=headers, params=params)
         if response.status_code in (200, 202):
             return response.json()
         else:
             # 401,403,405
             response.raise_for_status()
 
-    def add_articles(self, store_code, articles, chunk_size=5000):
+    def add_articles(
+        self, store_code, articles, chunk_size=AIMS_SAAS_CHUNK_MAX_ARTICLES
+    ):
         """
         Add articles for specific company code
+
+        Chunks hold at most chunk_size articles and follow the adaptive byte
+        budget, which is re-read after every chunk sent.
         """
-        if not self.access_token:
-            raise ValueError(
-                "Token not set. Please authenticate before making requests."
+        self.add_article_chunks(
+            store_code,
+            iter_article_chunks(
+                articles, max_articles=chunk_size, budget=self.chunk_budget
+            ),
+        )
+
+    def serialize_articles(self, articles, chunk_size=AIMS_SAAS_CHUNK_MAX_ARTICLES):
+        """
+        Serialize articles into JSON request bodies of at most chunk_size
+        articles and the current byte budget.
+
+        The bodies can be sent to any number of stores with add_article_chunks
+        without serializing the articles again.
+        """
+        return list(
+            iter_article_chunks(
+                articles,
+                max_articles=chunk_size,
+                max_bytes=self.chunk_budget.current_bytes,
             )
+        )
 
+    def add_article_chunks(self, store_code, article_chunks):
+        """
+        Add pre-serialized article chunks for specific company code
+        """
         endpoint = f"{self.BASE_URL}/api/v2/common/articles"
 
         headers = {
             "accept": "application/json",
-            "Authorization": f"Bearer {self.access_token}",
+            "Content-Type": "application/json",
         }
 
         params = {"company": self.company, "store": store_code}
 
-        while articles:
-            articles_chunk, articles = articles[:chunk_size], articles[chunk_size:]
-            response = requests.put(
-                endpoint, headers=headers, params=params, json=articles_chunk
+        for chunk_num, articles_chunk in enumerate(article_chunks, start=1):
+            response, bytes_sent = self._put_chunk(
+                endpoint, headers, params, articles_chunk
             )
             if response.status_code not in (200, 202):
                 # 401,403,405
                 logger.error(response.json().get("responseMessage", ""))
                 response.raise_for_status()
             else:
+                self.chunk_budget.observe(
+                    len(articles_chunk), response.elapsed.total_seconds()
+                )
+                self.upload_stats.record(articles_chunk, bytes_sent)
                 logger.debug(
-                    f"Sent {len(articles_chunk)} for store {store_code}, {len(articles)} pending"
+                    f"Sent chunk {chunk_num} ({articles_chunk.article_count} articles, {len(articles_chunk)} -> {bytes_sent} bytes) for store {store_code}"
                 )
 
-    def get_article(self, store_code, article_id):
+    def _put_chunk(self, endpoint, headers, params, articles_chunk):
         """
-        Get article for specific company code
+        PUT one chunk, gzip-compressed while the endpoint accepts it.
+
+        If a compressed body is rejected (400/415) and the same chunk goes
+        through uncompressed, compression is switched off for this client.
+        Returns the response and the number of body bytes sent.
         """
-        if not self.access_token:
-            raise ValueError(
-                "Token not set. Please authenticate before making requests."
+        if self.gzip_uploads:
+            body = articles_chunk.gzipped()
+            response = self._request(
+                "PUT",
+                endpoint,
+                headers={**headers, "Content-Encoding": "gzip"},
+                params=params,
+                data=body,
             )
+            if response.status_code not in (400, 415):
+                return response, len(body)
 
+        response = self._request(
+            "PUT", endpoint, headers=headers, params=params, data=articles_chunk.body
+        )
+        if self.gzip_uploads and response.status_code in (200, 202):
+            logger.error(
+                "AIMS rejected a gzip body but accepted it uncompressed, disabling compression"
+            )
+            self.gzip_uploads = False
+        return response, len(articles_chunk.body)
+
+    def get_article(self, store_code, article_id):
+        """
+        Get article for specific company code
+        """
         endpoint = f"{self.BASE_URL}/api/v1/articles/article"
 
-        headers = {
-            "accept": "application/json",
-            "Authorization": f"Bearer {self.access_token}",
-        }
+        headers = {"accept": "application/json"}
 
         params = {
             "company": self.company,
@@ -120,7 +269,7 @@ class AIMSSaaSAPIClient:
             "articleId": article_id,
         }
 
-        response = requests.get(endpoint, headers=headers, params=params)
+        response = self._request("GET", endpoint, headers=headers, params=params)
         if response.status_code not in (200, 202):
             # 401,403,405
             logger.error(response.json().get("responseMessage", ""))
@@ -133,20 +282,12 @@ class AIMSSaaSAPIClient:
         """
         Unlink a label for a given company and label code.
         """
-        if not self.access_token:
-            raise ValueError(
-                "Token not set. Please authenticate before making requests."
-            )
-
         endpoint = f"{self.BASE_URL}/api/v1/labels/unlink"
         params = {"company": self.company, "labelCode": label_code}
 
-        headers = {
-            "accept": "application/json",
-            "Authorization": f"Bearer {self.access_token}",
-        }
+        headers = {"accept": "application/json"}
 
-        response = requests.post(endpoint, headers=headers, params=params)
+        response = self._request("POST", endpoint, headers=headers, params=params)
         if response.status_code in (200, 202):
             return response.json()
         else:
@@ -0,0 +1,279 @@
+import asyncio
+import threading
+import httpx
+from modules.sduk.common import set_logger
+from modules.aims_saas.aims_saas_api_client import AIMSSaaSAPIClient
+from env import (
+    AIMS_SAAS_CONNECT_TIMEOUT,
+    AIMS_SAAS_READ_TIMEOUT,
+    AIMS_SAAS_HTTP2,
+    AIMS_SAAS_ASYNC_MAX_IN_FLIGHT,
+    AIMS_SAAS_CHUNKS_IN_FLIGHT_PER_STORE,
+    AIMS_SAAS_CHUNK_MAX_ARTICLES,
+    VERIFY_SSL,
+)
+
+logger = set_logger("SaaS Async Api")
+
+
+class AsyncAIMSSaaSAPIClient:
+    """
+    asyncio counterpart of AIMSSaaSAPIClient for article uploads.
+
+    Keeps up to chunks_in_flight_per_store chunk PUTs of one store and up to
+    max_in_flight PUTs overall in flight on one event loop. With HTTP/2 the
+    requests are multiplexed over a single connection where the server allows
+    it. Authentication is delegated to a (synchronous) token_client.
+
+    Chunks of one call may be applied by AIMS in any order, so a single call
+    must not contain the same article twice.
+
+    Use as async context manager:
+
+        async with AsyncAIMSSaaSAPIClient(SaasClient) as client:
+            await client.add_articles(store_code, articles)
+    """
+
+    def __init__(
+        self,
+        token_client=None,
+        max_in_flight=AIMS_SAAS_ASYNC_MAX_IN_FLIGHT,
+        chunks_in_flight_per_store=AIMS_SAAS_CHUNKS_IN_FLIGHT_PER_STORE,
+        http2=AIMS_SAAS_HTTP2,
+        timeout=(AIMS_SAAS_CONNECT_TIMEOUT, AIMS_SAAS_READ_TIMEOUT),
+    ):
+        self.token_client = (
+            token_client if token_client is not None else AIMSSaaSAPIClient()
+        )
+        self.BASE_URL = self.token_client.BASE_URL
+        self.company = self.token_client.company
+        self.max_in_flight = max(1, max_in_flight)
+        self.chunks_in_flight_per_store = max(1, chunks_in_flight_per_store)
+        self.http2 = http2
+        self.timeout = timeout
+        self.client = None
+        self.in_flight = None
+
+    async def __aenter__(self):
+        connect_timeout, read_timeout = self.timeout
+        self.client = httpx.AsyncClient(
+            http2=self.http2,
+            verify=VERIFY_SSL,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(
+                max_connections=self.max_in_flight,
+                max_keepalive_connections=self.max_in_flight,
+            ),
+        )
+        self.in_flight = asyncio.Semaphore(self.max_in_flight)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.client.aclose()
+        self.client = None
+
+    @property
+    def access_token(self):
+        return self.token_client.access_token
+
+    async def get_access_token(self):
+        """
+        Retrieve the authentication token through the token client.
+        """
+        return await asyncio.to_thread(self.token_client.get_access_token)
+
+    async def add_articles(
+        self, store_code, articles, chunk_size=AIMS_SAAS_CHUNK_MAX_ARTICLES
+    ):
+        """
+        Add articles for specific company code
+        """
+        await self.add_article_chunks(
+            store_code,
+            self.token_client.serialize_articles(articles, chunk_size=chunk_size),
+        )
+
+    async def add_article_chunks(self, store_code, article_chunks):
+        """
+        Add pre-serialized article chunks for specific company code, pipelined
+        """
+        endpoint = f"{self.BASE_URL}/api/v2/common/articles"
+
+        headers = {
+            "accept": "application/json",
+            "Content-Type": "application/json",
+        }
+
+        params = {"company": self.company, "store": store_code}
+        store_slots = asyncio.Semaphore(self.chunks_in_flight_per_store)
+
+        async def put_chunk(chunk_num, articles_chunk):
+            async with store_slots, self.in_flight:
+                response, bytes_sent = await self._put_chunk(
+                    endpoint, headers, params, articles_chunk
+                )
+            if response.status_code not in (200, 202):
+                # 401,403,405
+                logger.error(response.json().get("responseMessage", ""))
+                response.raise_for_status()
+            else:
+                self.token_client.chunk_budget.observe(
+                    len(articles_chunk), response.elapsed.total_seconds()
+                )
+                self.token_client.upload_stats.record(articles_chunk, bytes_sent)
+                logger.debug(
+                    f"Sent chunk {chunk_num}/{len(article_chunks)} ({articles_chunk.article_count} articles, {len(articles_chunk)} -> {bytes_sent} bytes) for store {store_code} via {response.http_version}"
+                )
+
+        await asyncio.gather(
+            *(
+                put_chunk(chunk_num, articles_chunk)
+                for chunk_num, articles_chunk in enumerate(article_chunks, start=1)
+            )
+        )
+
+    async def _put_chunk(self, endpoint, headers, params, articles_chunk):
+        """
+        PUT one chunk, gzip-compressed while the token client allows it.
+
+        Same fallback as AIMSSaaSAPIClient._put_chunk, the decision is shared
+        with the token client.
+        """
+        if self.token_client.gzip_uploads:
+            body = articles_chunk.gzipped()
+            response = await self._put(
+                endpoint, {**headers, "Content-Encoding": "gzip"}, params, body
+            )
+            if response.status_code not in (400, 415):
+                return response, len(body)
+
+        response = await self._put(endpoint, headers, params, articles_chunk.body)
+        if self.token_client.gzip_uploads and response.status_code in (200, 202):
+            logger.error(
+                "AIMS rejected a gzip body but accepted it uncompressed, disabling compression"
+            )
+            self.token_client.gzip_uploads = False
+        return response, len(articles_chunk.body)
+
+    async def _put(self, endpoint, headers, params, content):
+        """
+        Send an authenticated PUT, retrying once with a renewed token on 401.
+        """
+        tokens = self.token_client.tokens
+        access_token = tokens.access_token
+        if not tokens.is_valid():
+            access_token = await asyncio.to_thread(tokens.get_token)
+        for attempt in range(2):
+            response = await self.client.put(
+                endpoint,
+                headers={**headers, "Authorization": f"Bearer {access_token}"},
+                params=params,
+                content=content,
+            )
+            if response.status_code != 401 or attempt:
+                return response
+            logger.error(f"401 from {endpoint}, renewing access token and retrying")
+            access_token = await asyncio.to_thread(tokens.renew, access_token)
+
+    async def add_article_chunks_to_stores(self, store_codes, article_chunks):
+        """
+        Add the same pre-serialized article chunks to many stores.
+
+        Returns a dict mapping each failed store to its exception, a failing
+        store does not stop the others.
+        """
+        store_codes = list(store_codes)
+        results = await asyncio.gather(
+            *(
+                self.add_article_chunks(store_code, article_chunks)
+                for store_code in store_codes
+            ),
+            return_exceptions=True,
+        )
+        return {
+            store_code: result
+            for store_code, result in zip(store_codes, results)
+            if isinstance(result, BaseException)
+        }
+
+
+class AsyncAIMSSaaSRunner:
+    """
+    Blocking front of one AsyncAIMSSaaSAPIClient on a long-lived event loop.
+
+    The loop runs on its own daemon thread for the life of the runner, so
+    all callers, e.g. the store lanes, share its pooled HTTP/2 connections
+    and in-flight limits instead of opening a loop and client per push.
+    """
+
+    def __init__(self, token_client=None, **kwargs):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="aims-saas-async", daemon=True
+        )
+        self.thread.start()
+        self.client = self.run(
+            AsyncAIMSSaaSAPIClient(token_client, **kwargs).__aenter__()
+        )
+
+    def run(self, coroutine):
+        """
+        Run coroutine on the loop and wait for its result.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def add_article_chunks(self, store_code, article_chunks):
+        return self.run(self.client.add_article_chunks(store_code, article_chunks))
+
+    def add_article_chunks_to_stores(self, store_codes, article_chunks):
+        return self.run(
+            self.client.add_article_chunks_to_stores(store_codes, article_chunks)
+        )
+
+    def close(self):
+        self.run(self.client.__aexit__(None, None, None))
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+def main():
+    """
+    Compare the threaded and the asyncio fan-out against a local fake AIMS.
+    """
+    from time import perf_counter
+    from modules.aims_saas.fake_aims_server import FakeAIMSServer
+    from modules.sduk.store_lanes import StoreLanes
+
+    store_codes = [f"{store:04d}" for store in range(50)]
+    articles = [
+        {"articleId": str(article_id), "data": {"offer_type": "X"}}
+        for article_id in range(10000)
+    ]
+
+    with FakeAIMSServer(latency=0.05) as server:
+        client = AIMSSaaSAPIClient()
+        client.BASE_URL = server.url
+        client.get_access_token()
+        article_chunks = client.serialize_articles(articles, chunk_size=1000)
+
+        start = perf_counter()
+        lanes = StoreLanes()
+        lanes.submit_to_stores(store_codes, client.add_article_chunks, article_chunks)
+        lanes.shutdown()
+        threaded = perf_counter() - start
+
+        runner = AsyncAIMSSaaSRunner(client)
+        start = perf_counter()
+        runner.add_article_chunks_to_stores(store_codes, article_chunks)
+        pipelined = perf_counter() - start
+        runner.close()
+
+        print(f"{server.stats['requests']} chunk PUTs to {len(store_codes)} stores")
+        print(f"upload stats: {client.upload_stats.as_dict()}")
+        print(f"threaded fan-out:  {threaded:.2f}s")
+        print(f"asyncio pipelined: {pipelined:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import os
+import sqlite3
+import threading
+import orjson
+from hashlib import blake2b
+from time import time
+from modules.sduk.common import set_logger
+from modules.sduk.sduk import article_json_default
+from modules.sduk.sqlite_query import select_in
+from env import (
+    ARTICLE_CACHE_ENABLED,
+    ARTICLE_CACHE_PATH,
+    ARTICLE_CACHE_MAX_ENTRIES,
+    ARTICLE_CACHE_MAX_AGE_DAYS,
+)
+
+logger = set_logger("Article Cache")
+
+
+def hash_article(article):
+    return blake2b(
+        orjson.dumps(
+            article, default=article_json_default, option=orjson.OPT_SORT_KEYS
+        ),
+        digest_size=16,
+    ).digest()
+
+
+class ArticleDeltaCache:
+    """
+    Persistent (store, articleId) -> content hash of the last payload AIMS
+    accepted for that store.
+
+    Callers send only the articles whose hash changed and record the hashes
+    once AIMS accepted them. Entries older than max_age_days are evicted so
+    every article is re-sent at least that often, and the oldest entries are
+    dropped beyond max_entries. With enabled=False every article counts as
+    changed (full resync), clear() forgets one or all stores.
+    """
+
+    def __init__(
+        self,
+        path=ARTICLE_CACHE_PATH,
+        max_entries=ARTICLE_CACHE_MAX_ENTRIES,
+        max_age_days=ARTICLE_CACHE_MAX_AGE_DAYS,
+        enabled=ARTICLE_CACHE_ENABLED,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_days * 24 * 60 * 60
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.records_since_eviction = 0
+        self.db = None
+        if enabled:
+            self._open()
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS article_hashes ("
+            " store TEXT NOT NULL,"
+            " article_id TEXT NOT NULL,"
+            " hash BLOB NOT NULL,"
+            " updated REAL NOT NULL,"
+            " PRIMARY KEY (store, article_id)) WITHOUT ROWID"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS article_hashes_updated"
+            " ON article_hashes (updated)"
+        )
+        self.db.commit()
+
+    def hash_articles(self, articles):
+        """
+        Return the content hash of every article, aligned with articles.
+        """
+        return [hash_article(article) for article in articles]
+
+    def changed_indices(self, store, articles, hashes, force_full=False):
+        """
+        Return the indices of the articles whose hash differs from the last
+        accepted payload for store (all of them if disabled or force_full).
+        """
+        if not self.enabled or force_full:
+            return list(range(len(articles)))
+
+        article_ids = [article["articleId"] for article in articles]
+        known = {}
+        min_updated = time() - self.max_age_seconds
+        with self.lock:
+            known.update(
+                select_in(
+                    self.db,
+                    "SELECT article_id, hash FROM article_hashes"
+                    " WHERE store = ? AND updated >= ? AND article_id IN ({})",
+                    set(article_ids),
+                    params=(store, min_updated),
+                )
+            )
+        return [
+            index
+            for index, (article_id, digest) in enumerate(zip(article_ids, hashes))
+            if known.get(article_id) != digest
+        ]
+
+    def record(self, store, articles, hashes):
+        """
+        Remember hashes as accepted by AIMS for store.
+        """
+        if not self.enabled or not articles:
+            return
+        now = time()
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO article_hashes VALUES (?, ?, ?, ?)",
+                (
+                    (store, article["articleId"], digest, now)
+                    for article, digest in zip(articles, hashes)
+                ),
+            )
+            self.db.commit()
+            self.records_since_eviction += len(articles)
+            if self.records_since_eviction >= max(1000, self.max_entries // 100):
+                self._evict()
+
+    def _evict(self):
+        self.records_since_eviction = 0
+        removed = self.db.execute(
+            "DELETE FROM article_hashes WHERE updated < ?",
+            (time() - self.max_age_seconds,),
+        ).rowcount
+        (entries,) = self.db.execute("SELECT COUNT(*) FROM article_hashes").fetchone()
+        if entries > self.max_entries:
+            removed += self.db.execute(
+                "DELETE FROM article_hashes WHERE (store, article_id) IN ("
+                " SELECT store, article_id FROM article_hashes"
+                " ORDER BY updated LIMIT ?)",
+                (entries - self.max_entries,),
+            ).rowcount
+        self.db.commit()
+        if removed:
+            logger.debug(f"Evicted {removed} article hashes")
+
+    def clear(self, store=None):
+        """
+        Forget all hashes (of one store), forcing a full resync.
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            if store is None:
+                self.db.execute("DELETE FROM article_hashes")
+            else:
+                self.db.execute("DELETE FROM article_hashes WHERE store = ?", (store,))
+            self.db.commit()
+
+
+if __name__ == "__main__":
+    from sys import argv
+
+    if len(argv) > 1 and argv[1] == "clear":
+        store = argv[2] if len(argv) > 2 else None
+        ArticleDeltaCache(enabled=True).clear(store)
+        print(f"Cleared article cache for {store or 'all stores'}")
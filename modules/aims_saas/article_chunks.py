@@ -0,0 +1,137 @@
+import gzip
+import orjson
+import threading
+from modules.sduk.common import set_logger
+from modules.sduk.sduk import article_json_default
+from env import (
+    AIMS_SAAS_CHUNK_MAX_ARTICLES,
+    AIMS_SAAS_CHUNK_MAX_BYTES,
+    AIMS_SAAS_CHUNK_MIN_BYTES,
+    AIMS_SAAS_CHUNK_TARGET_SECONDS,
+    AIMS_SAAS_GZIP_LEVEL,
+)
+
+logger = set_logger("SaaS Chunks")
+
+
+class ArticleChunk:
+    """
+    One serialized article upload body.
+
+    The gzip-compressed variant is built on first use and kept, so a chunk
+    sent to many stores is compressed only once.
+    """
+
+    __slots__ = ("body", "article_count", "_gzipped")
+
+    def __init__(self, body, article_count):
+        self.body = body
+        self.article_count = article_count
+        self._gzipped = None
+
+    def __len__(self):
+        return len(self.body)
+
+    def gzipped(self, level=AIMS_SAAS_GZIP_LEVEL):
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.body, compresslevel=level, mtime=0)
+        return self._gzipped
+
+
+class UploadStats:
+    """
+    Counts chunks and bytes before/after compression over all uploads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.chunks = 0
+        self.articles = 0
+        self.bytes_serialized = 0
+        self.bytes_sent = 0
+
+    def record(self, chunk, bytes_sent):
+        with self.lock:
+            self.chunks += 1
+            self.articles += chunk.article_count
+            self.bytes_serialized += len(chunk.body)
+            self.bytes_sent += bytes_sent
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                "chunks": self.chunks,
+                "articles": self.articles,
+                "bytes_serialized": self.bytes_serialized,
+                "bytes_sent": self.bytes_sent,
+            }
+
+
+class AdaptiveChunkBudget:
+    """
+    Byte budget for article upload bodies, adapted to the AIMS response time.
+
+    A chunk that took longer than target_seconds halves the budget, a chunk
+    that used most of the budget and came back in under half the target grows
+    it by a quarter. The budget always stays within min_bytes and max_bytes.
+    """
+
+    def __init__(
+        self,
+        max_bytes=AIMS_SAAS_CHUNK_MAX_BYTES,
+        min_bytes=AIMS_SAAS_CHUNK_MIN_BYTES,
+        target_seconds=AIMS_SAAS_CHUNK_TARGET_SECONDS,
+    ):
+        self.max_bytes = max_bytes
+        self.min_bytes = min(min_bytes, max_bytes)
+        self.target_seconds = target_seconds
+        self.current_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def observe(self, body_bytes, seconds):
+        with self.lock:
+            if seconds > self.target_seconds:
+                budget = max(self.min_bytes, self.current_bytes // 2)
+            elif (
+                seconds < self.target_seconds / 2
+                and body_bytes >= self.current_bytes * 3 // 4
+            ):
+                budget = min(self.max_bytes, self.current_bytes * 5 // 4)
+            else:
+                return
+            if budget != self.current_bytes:
+                logger.debug(
+                    f"Chunk of {body_bytes} bytes took {seconds:.2f}s, budget {self.current_bytes} -> {budget} bytes"
+                )
+                self.current_bytes = budget
+
+
+def iter_article_chunks(
+    articles, max_articles=AIMS_SAAS_CHUNK_MAX_ARTICLES, max_bytes=None, budget=None
+):
+    """
+    Serialize articles into ArticleChunk JSON array bodies in a single pass.
+
+    A body holds at most max_articles articles and at most max_bytes bytes, or
+    budget.current_bytes read at every chunk boundary so the chunk size follows
+    the observed latency. An article larger than the byte limit is sent alone.
+    """
+    assert max_bytes is not None or budget is not None
+
+    parts = []
+    parts_bytes = 0
+    limit = budget.current_bytes if budget is not None else max_bytes
+    for article in articles:
+        encoded = orjson.dumps(article, default=article_json_default)
+        # brackets plus one comma per article
+        if parts and (
+            len(parts) >= max_articles or parts_bytes + len(encoded) + 2 > limit
+        ):
+            yield ArticleChunk(b"[" + b",".join(parts) + b"]", len(parts))
+            parts = []
+            parts_bytes = 0
+            limit = budget.current_bytes if budget is not None else max_bytes
+        parts.append(encoded)
+        parts_bytes += len(encoded) + 1
+    if parts:
+        yield ArticleChunk(b"[" + b",".join(parts) + b"]", len(parts))
@@ -0,0 +1,207 @@
+import gzip
+import json
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from urllib.parse import parse_qs, urlparse
+
+from modules.sduk.common import set_logger
+
+logger = set_logger("Fake AIMS")
+
+
+class _FakeHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+
+class FakeAIMSServer:
+    """
+    Local stand-in for the AIMS SaaS endpoints used by the adapter.
+
+    Answers token requests and article uploads with a configurable latency and
+    error rate and counts what it received, so clients can be exercised and
+    their throughput measured without the real service. The article upload
+    format it serves lists data_fields.
+    """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        latency=0.0,
+        error_rate=0.0,
+        token_ttl=3600,
+        accept_gzip=True,
+        data_fields=(),
+    ):
+        self.latency = latency
+        self.data_fields = list(data_fields)
+        self.accept_gzip = accept_gzip
+        self.error_rate = error_rate
+        self.token_ttl = token_ttl
+        self.lock = threading.Lock()
+        self.token_count = 0
+        self.valid_tokens = set()
+        self.reset_stats()
+        self.httpd = _FakeHTTPServer((host, port), self._handler_class())
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {
+                "requests": 0,
+                "errors": 0,
+                "token_requests": 0,
+                "unauthorized": 0,
+                "bytes_received": 0,
+                "articles": 0,
+                "articles_per_store": {},
+            }
+
+    def issue_token(self):
+        with self.lock:
+            self.token_count += 1
+            self.stats["token_requests"] += 1
+            access_token = f"fake-access-token-{self.token_count}"
+            self.valid_tokens.add(access_token)
+        return {
+            "access_token": access_token,
+            "refresh_token": f"fake-refresh-token-{self.token_count}",
+            "expires_in": self.token_ttl,
+        }
+
+    def expire_tokens(self):
+        """
+        Invalidate all issued access tokens, the next request gets a 401.
+        """
+        with self.lock:
+            self.valid_tokens.clear()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        logger.debug(f"Fake AIMS listening on {self.url}")
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+            def _read_body(self):
+                length = int(self.headers.get("Content-Length", 0))
+                return self.rfile.read(length) if length else b""
+
+            def _respond(self, status, payload):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                path = urlparse(self.path).path
+                self._read_body()
+                if path.endswith("/api/v2/token") or path.endswith(
+                    "/api/v2/token/refresh"
+                ):
+                    self._respond(200, {"responseMessage": server.issue_token()})
+                else:
+                    self._respond(200, {"responseMessage": "OK"})
+
+            def _is_authorized(self):
+                authorization = self.headers.get("Authorization", "")
+                access_token = authorization.removeprefix("Bearer ")
+                with server.lock:
+                    if access_token in server.valid_tokens:
+                        return True
+                    server.stats["unauthorized"] += 1
+                self._respond(401, {"responseMessage": "Token expired"})
+                return False
+
+            def do_PUT(self):
+                url = urlparse(self.path)
+                body = self._read_body()
+                with server.lock:
+                    server.stats["requests"] += 1
+                    server.stats["bytes_received"] += len(body)
+                if not self._is_authorized():
+                    return
+                if server.latency:
+                    sleep(server.latency)
+                if server.error_rate and random.random() < server.error_rate:
+                    with server.lock:
+                        server.stats["errors"] += 1
+                    self._respond(500, {"responseMessage": "Injected failure"})
+                    return
+
+                if url.path.endswith("/articles/upload/format"):
+                    self._respond(
+                        200, {"articleList": {"dataFieldList": server.data_fields}}
+                    )
+                    return
+
+                if self.headers.get("Content-Encoding") == "gzip":
+                    if not server.accept_gzip:
+                        self._respond(415, {"responseMessage": "Unsupported encoding"})
+                        return
+                    body = gzip.decompress(body)
+                articles = json.loads(body) if body else []
+                store = parse_qs(url.query).get("store", [""])[0]
+                with server.lock:
+                    server.stats["articles"] += len(articles)
+                    per_store = server.stats["articles_per_store"]
+                    per_store[store] = per_store.get(store, 0) + len(articles)
+                self._respond(202, {"responseMessage": "Accepted"})
+
+        return Handler
+
+
+def main():
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Run a fake AIMS SaaS endpoint")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = FakeAIMSServer(
+        port=args.port, latency=args.latency, error_rate=args.error_rate
+    )
+    print(f"Fake AIMS SaaS listening on {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+        print(json.dumps(server.stats, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import json
+import threading
+from base64 import urlsafe_b64decode
+from time import time
+from modules.sduk.common import set_logger
+from env import (
+    AIMS_SAAS_TOKEN_REFRESH_MARGIN,
+    AIMS_SAAS_TOKEN_DEFAULT_TTL,
+    AIMS_SAAS_TOKEN_BACKGROUND_REFRESH,
+)
+
+logger = set_logger("SaaS Token")
+
+
+def get_jwt_expiry(token):
+    """
+    Return the exp claim of a JWT access token, or None if it has none.
+    """
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(urlsafe_b64decode(payload))["exp"])
+    except Exception:
+        return None
+
+
+class AIMSSaaSTokenManager:
+    """
+    Keeps an AIMS SaaS access token valid for concurrent callers.
+
+    login() and refresh(refresh_token) are callables returning the
+    responseMessage of the token endpoints. The token is renewed
+    refresh_margin seconds before it expires, from a background thread if
+    background_refresh is set and otherwise on the next get_token() call.
+    Only one renewal runs at a time, callers keep using the current token
+    until the new one is in place.
+    """
+
+    def __init__(
+        self,
+        login=None,
+        refresh=None,
+        refresh_margin=AIMS_SAAS_TOKEN_REFRESH_MARGIN,
+        default_ttl=AIMS_SAAS_TOKEN_DEFAULT_TTL,
+        background_refresh=AIMS_SAAS_TOKEN_BACKGROUND_REFRESH,
+        clock=time,
+    ):
+        assert login is not None
+        self.login = login
+        self.refresh = refresh
+        self.refresh_margin = refresh_margin
+        self.default_ttl = default_ttl
+        self.background_refresh = background_refresh
+        self.clock = clock
+        self.access_token = None
+        self.refresh_token = None
+        self.expires_at = 0.0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.refresher = None
+
+    def is_valid(self):
+        return (
+            self.access_token is not None
+            and self.clock() < self.expires_at - self.refresh_margin
+        )
+
+    def get_token(self):
+        """
+        Return a valid access token, renewing it first if it is about to expire.
+        """
+        if self.is_valid():
+            return self.access_token
+        return self.renew()
+
+    def renew(self, stale_token=None):
+        """
+        Renew the access token.
+
+        With stale_token (e.g. after a 401) the token is only renewed if no
+        other caller has replaced it in the meantime.
+        """
+        with self.lock:
+            if stale_token is not None and stale_token != self.access_token:
+                return self.access_token
+            if stale_token is None and self.is_valid():
+                return self.access_token
+
+            response_message = None
+            if self.refresh is not None and self.refresh_token:
+                try:
+                    response_message = self.refresh(self.refresh_token)
+                except Exception as e:
+                    logger.error(f"Refreshing the access token failed: {e}")
+            if response_message is None:
+                response_message = self.login()
+            self._store(response_message)
+
+        if self.background_refresh:
+            self._start_refresher()
+        return self.access_token
+
+    def _store(self, response_message):
+        access_token = response_message["access_token"]
+        expires_in = response_message.get("expires_in")
+        if expires_in is not None:
+            expires_at = self.clock() + float(expires_in)
+        else:
+            expires_at = get_jwt_expiry(access_token)
+        if expires_at is None:
+            expires_at = self.clock() + self.default_ttl
+
+        self.access_token = access_token
+        self.refresh_token = response_message.get("refresh_token", self.refresh_token)
+        self.expires_at = expires_at
+        logger.debug(f"New access token valid for {expires_at - self.clock():.0f}s")
+
+    def _start_refresher(self):
+        with self.lock:
+            if self.refresher is not None and self.refresher.is_alive():
+                return
+            self.stop_event.clear()
+            self.refresher = threading.Thread(
+                target=self._refresh_loop, name="aims-token-refresh", daemon=True
+            )
+            self.refresher.start()
+
+    def _refresh_loop(self):
+        while True:
+            wait = max(5.0, self.expires_at - self.refresh_margin - self.clock())
+            if self.stop_event.wait(wait):
+                return
+            try:
+                self.get_token()
+            except Exception as e:
+                logger.error(f"Background token refresh failed: {e}")
+
+    def stop(self):
+        self.stop_event.set()
@@ -0,0 +1,165 @@
+import threading
+from operator import itemgetter
+from time import time
+from modules.sduk.common import set_logger
+from modules.sduk.sduk import ArticleData
+from env import (
+    AIMS_UPLOAD_FORMAT_PROJECTION,
+    AIMS_UPLOAD_FORMAT_TTL,
+    AIMS_UPLOAD_FORMAT_RETRY,
+)
+
+logger = set_logger("SaaS Upload Format")
+
+
+def upload_format_fields(upload_format):
+    """
+    Return the article data field names of an upload format response.
+    """
+    fields = (upload_format or {}).get("articleList", {}).get("dataFieldList") or []
+    return tuple(field for field in fields if isinstance(field, str))
+
+
+class ColumnPlan:
+    """
+    The columns of one file that AIMS stores, resolved once per file.
+
+    columns are the kept names in the file's column order and positions their
+    index in the file's rows, so a row is projected (select()) without
+    looking at the columns that are dropped.
+    """
+
+    __slots__ = ("columns", "positions", "dropped", "_getter", "_width")
+
+    def __init__(self, headers, keep):
+        kept = [(i, header) for i, header in enumerate(headers) if header in keep]
+        self.positions = tuple(i for i, _ in kept)
+        self.columns = tuple(header for _, header in kept)
+        self.dropped = len(headers) - len(kept)
+        self._getter = itemgetter(*self.positions) if len(kept) > 1 else None
+        # Rows at least this long have every kept column
+        self._width = self.positions[-1] + 1 if kept else 0
+
+    def select(self, row):
+        """
+        Return the kept values of row as a list. A short row only has the
+        kept columns it reaches, the first ones of columns, like a zip() of
+        headers and row into a dict.
+        """
+        if self._getter is not None and len(row) >= self._width:
+            return list(self._getter(row))
+        return [row[i] for i in self.positions if i < len(row)]
+
+
+class ArticleUploadFormat:
+    """
+    Cached AIMS article upload format, the data fields AIMS stores.
+
+    fetch() is a callable returning the upload format response. It is fetched
+    on first use and again after ttl seconds, a failed fetch is retried after
+    retry seconds and keeps the last known fields. Without known fields
+    (disabled, not fetched, or an empty format) nothing is projected and
+    articles are sent as they are.
+    """
+
+    def __init__(
+        self,
+        fetch=None,
+        enabled=AIMS_UPLOAD_FORMAT_PROJECTION,
+        ttl=AIMS_UPLOAD_FORMAT_TTL,
+        retry=AIMS_UPLOAD_FORMAT_RETRY,
+        clock=time,
+    ):
+        assert fetch is not None
+        self.fetch = fetch
+        self.enabled = enabled
+        self.ttl = ttl
+        self.retry = retry
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.field_list = None
+        self.field_set = None
+        self.expires_at = 0.0
+
+    def fields(self):
+        """
+        Return the stored data fields in format order, or None to send
+        everything.
+        """
+        if not self.enabled:
+            return None
+        with self.lock:
+            if self.clock() >= self.expires_at:
+                self._refresh()
+            return self.field_list
+
+    def _refresh(self):
+        try:
+            fields = upload_format_fields(self.fetch())
+        except Exception as e:
+            logger.error(f"Fetching the article upload format failed: {e}")
+            self.expires_at = self.clock() + self.retry
+            return
+        self.expires_at = self.clock() + self.ttl
+        if not fields:
+            logger.debug("Empty article upload format, sending all data fields")
+            self.field_list = self.field_set = None
+            return
+        if self.field_set != frozenset(fields):
+            logger.info(f"Article upload format has {len(fields)} data fields")
+        self.field_list = fields
+        self.field_set = frozenset(fields)
+
+    def column_plan(self, headers, keep=()):
+        """
+        Return the ColumnPlan of a file with headers, keeping the stored
+        fields and keep (e.g. fields needed before sending), or None if
+        everything is kept.
+        """
+        fields = self.fields()
+        if fields is None:
+            return None
+        field_set = frozenset(fields)
+        if field_set.isdisjoint(headers):
+            logger.error(
+                "None of the file's columns are in the article upload format, not projecting"
+            )
+            return None
+        plan = ColumnPlan(headers, field_set.union(keep))
+        return plan if plan.dropped else None
+
+    def project_articles(self, articles):
+        """
+        Return articles with only the stored data fields.
+
+        ArticleData is projected through its schema and stays compact, data
+        dicts are rebuilt from the upload format's field list. Either way the
+        cost follows the stored fields and not the file's columns.
+        """
+        fields = self.fields()
+        if fields is None or not articles:
+            return articles
+        projected = []
+        kept_total = dropped = 0
+        for article in articles:
+            data = article.get("data")
+            if data is None:
+                projected.append(article)
+                continue
+            if isinstance(data, ArticleData):
+                kept = data.project(fields)
+            else:
+                kept = {field: data[field] for field in fields if field in data}
+            kept_total += len(kept)
+            dropped += len(data) - len(kept)
+            projected.append({**article, "data": kept})
+        if not kept_total and dropped:
+            logger.error(
+                "None of the data fields are in the article upload format, not projecting"
+            )
+            return articles
+        if dropped:
+            logger.debug(
+                f"Dropped {dropped} data fields AIMS does not store from {len(articles)} articles"
+            )
+        return projected
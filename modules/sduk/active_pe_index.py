@@ -0,0 +1,120 @@
+import os
+import sqlite3
+import threading
+from modules.sduk.common import set_logger
+from modules.sduk.sqlite_query import select_in
+from env import ACTIVE_PE_INDEX_PATH
+
+logger = set_logger("Active PE Index")
+
+
+class ActivePEIndex:
+    """
+    Persistent inverted index articleId -> active PE0033 blobs.
+
+    Blobs are added when a PE file is activated and removed when it is
+    deactivated, so finding the still-active files that share articles with
+    an ending file is a lookup instead of downloading every active blob.
+    sync() reconciles the index with the blobs actually present, indexing
+    unknown ones once and dropping vanished ones.
+    """
+
+    def __init__(self, path=ACTIVE_PE_INDEX_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS pe_blobs ("
+            " blob_name TEXT PRIMARY KEY, promo_type TEXT)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS pe_articles ("
+            " article_id TEXT NOT NULL,"
+            " blob_name TEXT NOT NULL,"
+            " PRIMARY KEY (article_id, blob_name)) WITHOUT ROWID"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS pe_articles_blob ON pe_articles (blob_name)"
+        )
+        self.db.commit()
+
+    def add(self, blob_name, article_ids, promo_type=None):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO pe_blobs VALUES (?, ?)", (blob_name, promo_type)
+            )
+            self.db.execute("DELETE FROM pe_articles WHERE blob_name = ?", (blob_name,))
+            self.db.executemany(
+                "INSERT OR IGNORE INTO pe_articles VALUES (?, ?)",
+                ((article_id, blob_name) for article_id in article_ids),
+            )
+            self.db.commit()
+        logger.debug(f"Indexed {blob_name}")
+
+    def remove(self, blob_name):
+        with self.lock:
+            self.db.execute("DELETE FROM pe_articles WHERE blob_name = ?", (blob_name,))
+            self.db.execute("DELETE FROM pe_blobs WHERE blob_name = ?", (blob_name,))
+            self.db.commit()
+        logger.debug(f"Removed {blob_name} from index")
+
+    def blob_names(self):
+        with self.lock:
+            return {row[0] for row in self.db.execute("SELECT blob_name FROM pe_blobs")}
+
+    def get(self, blob_name):
+        """
+        Return the article ids and promo type of an indexed blob.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT promo_type FROM pe_blobs WHERE blob_name = ?", (blob_name,)
+            ).fetchone()
+            article_ids = {
+                article_id
+                for (article_id,) in self.db.execute(
+                    "SELECT article_id FROM pe_articles WHERE blob_name = ?",
+                    (blob_name,),
+                )
+            }
+        return article_ids, (row[0] if row else None)
+
+    def find_overlaps(self, article_ids, blob_names):
+        """
+        Return {blob_name: shared article ids} for the blob_names sharing
+        any of article_ids.
+        """
+        blob_names = set(blob_names)
+        overlaps = {}
+        with self.lock:
+            rows = select_in(
+                self.db,
+                "SELECT article_id, blob_name FROM pe_articles WHERE article_id IN ({})",
+                article_ids,
+            )
+            for article_id, blob_name in rows:
+                if blob_name in blob_names:
+                    overlaps.setdefault(blob_name, set()).add(article_id)
+        return overlaps
+
+    def sync(self, blob_names, load=None):
+        """
+        Make the index cover exactly blob_names.
+
+        load(blob_name) -> (article_ids, promo_type) is called for blobs not yet
+        indexed, e.g. after the index file was lost.
+        """
+        blob_names = set(blob_names)
+        indexed = self.blob_names()
+        for blob_name in indexed - blob_names:
+            self.remove(blob_name)
+        for blob_name in sorted(blob_names - indexed):
+            if load is None:
+                continue
+            logger.info(f"{blob_name} missing from the active PE index, indexing it")
+            article_ids, promo_type = load(blob_name)
+            self.add(blob_name, article_ids, promo_type)
@@ -1,38 +1,48 @@
-from azure.storage.blob import BlobServiceClient, BlobLeaseClient
+from azure.storage.blob import (
+    BlobServiceClient,
+    BlobLeaseClient,
+    BlobPrefix,
+    BlobSasPermissions,
+    generate_blob_sas,
+)
 from env import (
     AZURE_ACCOUNT_CONTAINER,
     AZURE_ACCOUNT_KEY,
     AZURE_ACCOUNT_NAME,
+    AZURE_ACCOUNT_URL,
     LOG_LEVEL_AZURE,
     BLOB_ARCHIVE_DIR,
     BLOB_INPUT_DIR,
-    BLOB_QUEUE_DIR,
 )
 from time import sleep
 from modules.sduk.common import set_logger
+from modules.sduk.storage import BlobError, BlobStore
 from azure.core import exceptions as azure_exceptions
 from datetime import datetime, timedelta
 
 logger = set_logger("azure.storage")
 logger.setLevel(LOG_LEVEL_AZURE)
 
+# Most sub-requests a blob batch request may hold
+BATCH_MAX_BLOBS = 256
 
-class BlobError(Exception):
-    def __init__(self, message):
-        super().__init__(message)
 
+class AzureBlob(BlobStore):
+    batch_size = BATCH_MAX_BLOBS
 
-class AzureBlob:
     def __init__(
         self,
         azure_account_name=AZURE_ACCOUNT_NAME,
         azure_account_key=AZURE_ACCOUNT_KEY,
         azure_account_container=AZURE_ACCOUNT_CONTAINER,
+        azure_account_url=AZURE_ACCOUNT_URL,
     ):
-        self.lease_breaker = {}
+        super().__init__()
+        self.account_name = azure_account_name
+        self.account_key = azure_account_key
         try:
             self.service = BlobServiceClient(
-                account_url="https://segdemoaks01sftp.blob.core.windows.net/",
+                account_url=azure_account_url,
                 credential={
                     "account_name": azure_account_name,
                     "account_key": azure_account_key,
@@ -49,38 +59,88 @@ class AzureBlob:
     def list_blobs(self, name_starts_with=""):
         return self.container.list_blob_names(name_starts_with=name_starts_with)
 
+    def iter_blobs_with_properties(self, name_starts_with=""):
+        """
+        Yield (blob name, size) in name order, listing pages are only
+        requested as far as the caller iterates.
+        """
+        for blob in self.container.list_blobs(name_starts_with=name_starts_with):
+            yield blob.name, blob.size
+
+    def list_blob_etags(self, name_starts_with=""):
+        return {
+            blob.name: blob.etag
+            for blob in self.container.list_blobs(name_starts_with=name_starts_with)
+        }
+
+    def list_blob_names_in_dir(self, dir_name=None):
+        """
+        Return the names of the blobs directly in dir_name, subdirectories
+        are listed as one prefix each and left out.
+        """
+        assert dir_name is not None
+        return [
+            item.name
+            for item in self.container.walk_blobs(
+                name_starts_with=f"{dir_name}/", delimiter="/"
+            )
+            if not isinstance(item, BlobPrefix)
+        ]
+
     def get_blob(self, blob=None):
         assert blob is not None
         return self.container.get_blob_client(blob=blob)
 
-    def get_blob_with_lease(self, blob_name=None, lease_duration=-1):
-        assert blob_name is not None
-        blob = self.container.get_blob_client(blob=blob_name)
-        now = datetime.now()
-        if blob.get_blob_properties().size == 0:
-            raise BlobError(f"{blob_name} - size=0")
-        try:
-            blob_lease = blob.acquire_lease(lease_duration=lease_duration)
-        except azure_exceptions.ResourceExistsError as e:
-            if blob_name not in self.lease_breaker:
-                self.lease_breaker[blob_name] = now
-            else:
-                lease_delta = now - self.lease_breaker[blob_name]
-                logger.error(f"Stale lease for {blob_name} found {lease_delta} old")
-                if lease_delta > timedelta(minutes=5):
-                    logger.error(f"Stale Lease older than 5 minutes -> Breaking")
-                    BlobLeaseClient(blob).break_lease()
-            raise e
-        if blob_name in self.lease_breaker:
-            self.lease_breaker.pop(blob_name)
-        return blob, blob_lease
-
-    def copy_blob(self, src_name=None, tgt_name=None):
+    def _acquire_lease(self, blob, lease_duration):
+        return blob.acquire_lease(lease_duration=lease_duration)
+
+    def _break_lease(self, blob):
+        BlobLeaseClient(blob).break_lease()
+
+    def _source_url(self, src_blob):
+        """
+        URL of src_blob with a short-lived read SAS, synchronous copies need
+        an authorized source even within the account.
+        """
+        sas = generate_blob_sas(
+            account_name=self.account_name,
+            container_name=src_blob.container_name,
+            blob_name=src_blob.blob_name,
+            account_key=self.account_key,
+            permission=BlobSasPermissions(read=True),
+            expiry=datetime.utcnow() + timedelta(minutes=15),
+        )
+        return f"{src_blob.url}?{sas}"
+
+    def copy_blob(self, src_name=None, tgt_name=None, data=None):
+        """
+        Copy src_name to tgt_name without waiting on a pending copy.
+
+        With data (the source bytes already at hand) the target is uploaded
+        directly, otherwise a synchronous server-side copy is used. Only if
+        that is refused, e.g. for sources over 256 MiB, the asynchronous
+        copy is started and polled.
+        """
         assert src_name is not None
         assert tgt_name is not None
         src_blob = self.get_blob(src_name)
         tgt_blob = self.get_blob(tgt_name)
-        logger.debug(f"Copying {src_name} -> {tgt_blob}")
+        if data is not None:
+            logger.debug(f"Uploading {src_name} -> {tgt_name}")
+            tgt_blob.upload_blob(data, overwrite=True)
+            return True
+        logger.debug(f"Copying {src_name} -> {tgt_name}")
+        try:
+            copy = tgt_blob.start_copy_from_url(
+                self._source_url(src_blob), requires_sync=True
+            )
+            if copy["copy_status"] == "success":
+                return True
+        except azure_exceptions.HttpResponseError as e:
+            logger.debug(f"Synchronous copy of {src_name} refused: {e}")
+        return self._poll_copy(src_name, src_blob, tgt_blob)
+
+    def _poll_copy(self, src_name, src_blob, tgt_blob):
         tgt_blob.start_copy_from_url(src_blob.url)
         status = None
         for _ in range(20):
@@ -95,10 +155,29 @@ class AzureBlob:
         else:
             return True
 
-    def move_blob(self, src_name=None, tgt_name=None, src_lease=None):
-        if self.copy_blob(src_name, tgt_name):
-            logger.debug(f"Deleting {src_name}")
-            self.get_blob(src_name).delete_blob(lease=src_lease)
+    def delete_blobs(self, blobs):
+        """
+        Delete [(blob name, lease or None)] with one batch request per
+        BATCH_MAX_BLOBS blobs. Blobs already gone count as deleted.
+        """
+        blobs = list(blobs)
+        failures = {}
+        for start in range(0, len(blobs), BATCH_MAX_BLOBS):
+            batch = blobs[start : start + BATCH_MAX_BLOBS]
+            responses = self.container.delete_blobs(
+                *[
+                    {"name": name, "lease_id": lease} if lease else name
+                    for name, lease in batch
+                ],
+                raise_on_any_failure=False,
+            )
+            for (name, _), response in zip(batch, responses):
+                if response.status_code not in (202, 404):
+                    failures[name] = BlobError(
+                        f"Deleting {name} failed with {response.status_code}"
+                    )
+        logger.debug(f"Deleted {len(blobs) - len(failures)}/{len(blobs)} blobs")
+        return failures
 
 
 if __name__ == "__main__":
@@ -0,0 +1,364 @@
+import os
+import shutil
+import threading
+import uuid
+from concurrent.futures import Future
+from tempfile import NamedTemporaryFile
+from time import time
+from types import SimpleNamespace
+from azure.core import exceptions as azure_exceptions
+from modules.sduk.common import set_logger
+from modules.sduk.storage import BlobError, BlobStore
+
+logger = set_logger("Local Blob Store")
+
+# Hidden directories of the store root, never listed as blobs
+LEASE_DIR = ".leases"
+TMP_DIR = ".tmp"
+
+
+class LocalLease:
+    def __init__(self, store, blob_name, lease_id):
+        self.store = store
+        self.blob_name = blob_name
+        self.id = lease_id
+
+    def release(self):
+        self.store._release_lease(self.blob_name, self.id)
+
+
+class LocalDownload:
+    def __init__(self, path, offset=None, length=None):
+        self.path = path
+        self.offset = offset or 0
+        self.length = length
+
+    def readall(self):
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            return f.read() if self.length is None else f.read(self.length)
+
+    def readinto(self, stream):
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            if self.length is not None:
+                data = f.read(self.length)
+                stream.write(data)
+                return len(data)
+            shutil.copyfileobj(f, stream)
+            return f.tell() - self.offset
+
+
+class LocalBlobClient:
+    """
+    Blob handle with the BlobClient methods the adapter uses.
+    """
+
+    def __init__(self, store, blob_name):
+        self.store = store
+        self.blob_name = blob_name
+        self.path = store._path(blob_name)
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def get_blob_properties(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            raise azure_exceptions.ResourceNotFoundError(f"{self.blob_name} not found")
+        return SimpleNamespace(size=stat.st_size, etag=_etag(stat))
+
+    def download_blob(self, offset=None, length=None):
+        if not self.exists():
+            raise azure_exceptions.ResourceNotFoundError(f"{self.blob_name} not found")
+        return LocalDownload(self.path, offset, length)
+
+    def upload_blob(self, data, overwrite=False):
+        self.store._write(self.blob_name, data, overwrite)
+
+    def delete_blob(self, lease=None):
+        self.store._delete(self.blob_name, lease)
+
+
+class LocalBlobStore(BlobStore):
+    """
+    Blob store on a local directory tree, blob names are paths below root.
+
+    Every write goes to a temporary file that is renamed into place, so a
+    blob is either complete or absent, and moves are single renames. Leases
+    are lock files created exclusively under root/.leases, holding the
+    lease id and expiry. Hidden files, like the .gitkeep of the shipped data
+    directories, are not listed.
+    """
+
+    def __init__(self, root=None):
+        assert root is not None
+        super().__init__()
+        self.root = os.path.abspath(root)
+        # Held while creating directories and the entry in them, and while
+        # pruning, so a prune can not remove a directory being written to
+        self.tree_lock = threading.Lock()
+        os.makedirs(os.path.join(self.root, TMP_DIR), exist_ok=True)
+        os.makedirs(os.path.join(self.root, LEASE_DIR), exist_ok=True)
+
+    def _path(self, blob_name):
+        return os.path.join(self.root, *blob_name.split("/"))
+
+    def _lease_path(self, blob_name):
+        return os.path.join(self.root, LEASE_DIR, *blob_name.split("/")) + ".lock"
+
+    def _walk(self, name_starts_with=""):
+        # Only the directory tree the prefix can be in is walked
+        top = (
+            name_starts_with.rsplit("/", maxsplit=1)[0]
+            if "/" in name_starts_with
+            else ""
+        )
+        names = []
+        for dirpath, dirnames, filenames in os.walk(
+            self._path(top) if top else self.root
+        ):
+            dirnames[:] = [name for name in dirnames if not name.startswith(".")]
+            relative = os.path.relpath(dirpath, self.root).replace(os.sep, "/")
+            for filename in filenames:
+                if filename.startswith("."):
+                    continue
+                name = filename if relative == "." else f"{relative}/{filename}"
+                if name.startswith(name_starts_with):
+                    names.append(name)
+        return sorted(names)
+
+    def list_blobs(self, name_starts_with=""):
+        return self._walk(name_starts_with)
+
+    def iter_blobs_with_properties(self, name_starts_with=""):
+        for name in self._walk(name_starts_with):
+            try:
+                yield name, os.stat(self._path(name)).st_size
+            except FileNotFoundError:
+                continue
+
+    def list_blob_etags(self, name_starts_with=""):
+        etags = {}
+        for name in self._walk(name_starts_with):
+            try:
+                etags[name] = _etag(os.stat(self._path(name)))
+            except FileNotFoundError:
+                continue
+        return etags
+
+    def list_blob_names_in_dir(self, dir_name=None):
+        assert dir_name is not None
+        try:
+            entries = list(os.scandir(self._path(dir_name)))
+        except FileNotFoundError:
+            return []
+        return sorted(
+            f"{dir_name}/{entry.name}"
+            for entry in entries
+            if entry.is_file() and not entry.name.startswith(".")
+        )
+
+    def get_blob(self, blob=None):
+        assert blob is not None
+        return LocalBlobClient(self, blob)
+
+    def _write(self, blob_name, data, overwrite):
+        path = self._path(blob_name)
+        with NamedTemporaryFile(
+            dir=os.path.join(self.root, TMP_DIR), delete=False
+        ) as f:
+            if isinstance(data, (bytes, bytearray, memoryview)):
+                f.write(data)
+            else:
+                shutil.copyfileobj(data, f)
+            tmp_path = f.name
+        try:
+            with self.tree_lock:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                if overwrite:
+                    os.replace(tmp_path, path)
+                    return
+                try:
+                    # Fails if the blob exists, unlike a rename
+                    os.link(tmp_path, path)
+                except FileExistsError:
+                    raise azure_exceptions.ResourceExistsError(f"{blob_name} exists")
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _check_lease(self, blob_name, lease):
+        held = self._read_lease(blob_name)
+        if held is not None and (lease is None or lease.id != held):
+            raise BlobError(f"{blob_name} is leased")
+
+    def _delete(self, blob_name, lease=None):
+        self._check_lease(blob_name, lease)
+        try:
+            os.remove(self._path(blob_name))
+        except FileNotFoundError:
+            raise azure_exceptions.ResourceNotFoundError(f"{blob_name} not found")
+        self._remove_lease(blob_name)
+        self._prune(os.path.dirname(self._path(blob_name)))
+
+    def _prune(self, directory):
+        """
+        Remove directories emptied by a delete or move, e.g. queue buckets.
+        """
+        with self.tree_lock:
+            while directory != self.root and os.path.dirname(directory) != self.root:
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    return
+                directory = os.path.dirname(directory)
+
+    def copy_blob(self, src_name=None, tgt_name=None, data=None):
+        assert src_name is not None
+        assert tgt_name is not None
+        if data is not None:
+            self._write(tgt_name, data, overwrite=True)
+            return True
+        with open(self._path(src_name), "rb") as f:
+            self._write(tgt_name, f, overwrite=True)
+        return True
+
+    def move_blob(
+        self, src_name=None, tgt_name=None, src_lease=None, data=None, background=False
+    ):
+        """
+        Rename src_name to tgt_name, returns whether it was moved (a Future
+        of it with background=True, the rename is done already).
+        """
+        assert src_name is not None
+        assert tgt_name is not None
+        self._check_lease(src_name, src_lease)
+        logger.debug(f"Renaming {src_name} -> {tgt_name}")
+        target = self._path(tgt_name)
+        with self.tree_lock:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(self._path(src_name), target)
+        self._remove_lease(src_name)
+        self._prune(os.path.dirname(self._path(src_name)))
+        if background:
+            moved = Future()
+            moved.set_result(True)
+            return moved
+        return True
+
+    def delete_blobs(self, blobs):
+        failures = {}
+        for name, lease in blobs:
+            try:
+                self._delete(name, lease)
+            except azure_exceptions.ResourceNotFoundError:
+                pass
+            except BlobError as e:
+                failures[name] = e
+        return failures
+
+    def delete_later(self, blob_name=None, lease=None):
+        """
+        Delete blob_name right away, there is nothing to batch locally.
+        """
+        assert blob_name is not None
+        future = Future()
+        failures = self.delete_blobs([(blob_name, lease)])
+        if blob_name in failures:
+            future.set_exception(failures[blob_name])
+        else:
+            future.set_result(True)
+        return future
+
+    def _read_lease(self, blob_name):
+        """
+        Return the id of the unexpired lease on blob_name, or None.
+        """
+        return _read_lease_file(self._lease_path(blob_name))
+
+    def _acquire_lease(self, blob, lease_duration):
+        if not blob.exists():
+            raise azure_exceptions.ResourceNotFoundError(f"{blob.blob_name} not found")
+        lease_path = self._lease_path(blob.blob_name)
+        lease_id = str(uuid.uuid4())
+        expires = -1 if lease_duration < 0 else time() + lease_duration
+        # Written first and linked into place, a lock file is never seen
+        # without its id and expiry
+        with NamedTemporaryFile(
+            "w", dir=os.path.join(self.root, TMP_DIR), delete=False
+        ) as f:
+            f.write(f"{lease_id} {expires}")
+            tmp_path = f.name
+        try:
+            for _ in range(2):
+                try:
+                    with self.tree_lock:
+                        os.makedirs(os.path.dirname(lease_path), exist_ok=True)
+                        os.link(tmp_path, lease_path)
+                    return LocalLease(self, blob.blob_name, lease_id)
+                except FileExistsError:
+                    if not self._take_over_lease(blob.blob_name):
+                        break
+        finally:
+            os.remove(tmp_path)
+        raise azure_exceptions.ResourceExistsError(
+            f"{blob.blob_name} is already leased"
+        )
+
+    def _take_over_lease(self, blob_name):
+        """
+        Remove the expired lease on blob_name, return False if it is held.
+        """
+        if self._read_lease(blob_name) is not None:
+            return False
+        # Moved aside first, a lease taken in the meantime is put back
+        lease_path = self._lease_path(blob_name)
+        stale_path = os.path.join(self.root, TMP_DIR, f"{uuid.uuid4()}.lock")
+        try:
+            os.rename(lease_path, stale_path)
+        except FileNotFoundError:
+            return True
+        try:
+            if _read_lease_file(stale_path) is None:
+                return True
+            try:
+                os.link(stale_path, lease_path)
+            except FileExistsError:
+                pass
+            return False
+        finally:
+            os.remove(stale_path)
+
+    def _release_lease(self, blob_name, lease_id):
+        if self._read_lease(blob_name) == lease_id:
+            self._remove_lease(blob_name)
+
+    def _remove_lease(self, blob_name):
+        try:
+            os.remove(self._lease_path(blob_name))
+        except FileNotFoundError:
+            return
+        self._prune(os.path.dirname(self._lease_path(blob_name)))
+
+    def _break_lease(self, blob):
+        self._remove_lease(blob.blob_name)
+
+
+def _read_lease_file(path):
+    """
+    Return the id of the unexpired lease in the lock file at path, or None.
+    """
+    try:
+        with open(path) as f:
+            lease_id, expires = f.read().split()
+    except (FileNotFoundError, ValueError):
+        return None
+    if float(expires) >= 0 and float(expires) < time():
+        return None
+    return lease_id
+
+
+def _etag(stat):
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
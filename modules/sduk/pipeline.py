@@ -0,0 +1,55 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+
+def iter_batches(iterable=None, size=None):
+    """
+    Yield lists of up to size items of iterable, consuming it lazily.
+    """
+    assert iterable is not None
+    assert size is not None and size > 0
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def drain_in_order(batches=None, func=None, in_flight=2, name="pipeline"):
+    """
+    Run func(batch) for every batch on one worker thread, in order, while
+    the next batches are produced.
+
+    At most in_flight batches are waiting for or running in func, producing
+    the next one blocks until the oldest is done, so memory stays bounded by
+    a few batches and a slow func slows the producer down. After a failure
+    the batches behind it are not run and the exception is raised. Returns
+    the results of func.
+    """
+    assert batches is not None
+    assert func is not None
+    failed = threading.Event()
+
+    def run(batch):
+        if failed.is_set():
+            return None
+        try:
+            return func(batch)
+        except BaseException:
+            failed.set()
+            raise
+
+    results = []
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix=name) as worker:
+        try:
+            for batch in batches:
+                if len(pending) >= max(1, in_flight):
+                    results.append(pending.popleft().result())
+                pending.append(worker.submit(run, batch))
+            while pending:
+                results.append(pending.popleft().result())
+        except BaseException:
+            failed.set()
+            raise
+    return results
@@ -0,0 +1,81 @@
+import pytz
+from datetime import datetime
+from modules.sduk.common import set_logger
+from env import BLOB_QUEUE_DIR
+
+logger = set_logger("Queue Index")
+
+# Queued blobs are stored in one directory per UTC hour they become due in,
+# "{queue_dir}/{bucket}/{iso}|{hash}|{name}". Bucket names sort in time order,
+# so a listing can stop at the first bucket that is not due yet.
+BUCKET_FORMAT = "%Y-%m-%dT%H"
+
+
+class QueueNameError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+
+def queue_bucket(due=None):
+    """
+    Bucket directory of a due time.
+    """
+    assert due is not None
+    return due.astimezone(pytz.UTC).strftime(BUCKET_FORMAT)
+
+
+def queue_blob_name(due=None, csv_hash=None, filename=None, queue_dir=BLOB_QUEUE_DIR):
+    assert due is not None
+    assert csv_hash is not None
+    assert filename is not None
+    return f"{queue_dir}/{queue_bucket(due)}/{due.isoformat()}|{csv_hash}|{filename}"
+
+
+def parse_queue_blob_name(blob_name=None):
+    """
+    Return (due datetime, csv hash, file name) of a bucketed or a legacy flat
+    "{queue_dir}/{iso}|{hash}|{name}" queue blob.
+    """
+    assert blob_name is not None
+    try:
+        due_iso, csv_hash, filename = blob_name.rsplit("/", maxsplit=1)[-1].split("|")
+        return datetime.fromisoformat(due_iso), csv_hash, filename
+    except ValueError as e:
+        raise QueueNameError(f"{blob_name} is not a queue blob name: {e}")
+
+
+def is_bucketed(blob_name=None, queue_dir=BLOB_QUEUE_DIR):
+    assert blob_name is not None
+    return "/" in blob_name.removeprefix(f"{queue_dir}/")
+
+
+def due_queue_blobs(listing=None, now=None, queue_dir=BLOB_QUEUE_DIR):
+    """
+    Return the [(blob name, size)] of listing that are due at now, ordered by
+    due time, and the earliest due time after now seen (or None).
+
+    listing is a lazy (blob name, size) iteration in name order of the queue
+    directory. It is consumed only up to the first bucket after the one of
+    now, so the cost follows the due work and not the queue depth.
+    """
+    assert listing is not None
+    assert now is not None
+    now_bucket = queue_bucket(now)
+    due = []
+    next_due = None
+    for blob_name, size in listing:
+        try:
+            due_time = parse_queue_blob_name(blob_name)[0]
+        except QueueNameError as e:
+            logger.error(e)
+            continue
+        if due_time < now:
+            due.append((due_time, blob_name, size))
+        elif next_due is None or due_time < next_due:
+            next_due = due_time
+        if is_bucketed(blob_name, queue_dir):
+            bucket = blob_name.removeprefix(f"{queue_dir}/").split("/", maxsplit=1)[0]
+            if bucket > now_bucket:
+                break
+    due.sort()
+    return [(blob_name, size) for _, blob_name, size in due], next_due
@@ -0,0 +1,108 @@
+import threading
+import pytz
+from datetime import datetime, timedelta
+from modules.sduk.common import set_logger
+from env import SCHEDULER_MIN_POLL, SCHEDULER_MAX_POLL
+
+logger = set_logger("Scheduler")
+
+
+class SystemClock:
+    def now(self):
+        return datetime.now(tz=pytz.UTC)
+
+    def wait(self, event, timeout):
+        """
+        Block until event is set or timeout seconds passed.
+        """
+        return event.wait(timeout)
+
+
+class Scheduler:
+    """
+    Wake-up times of the periodic tasks of the main loop.
+
+    Every task has the time it is next due at. Tasks report the next time
+    they have work for when they ran (done()), producers of new work move
+    a task forward with schedule() and notify() wakes the loop right away,
+    e.g. from a change notification. A task is re-run at least every
+    max_poll seconds and at most every min_poll seconds. The input probe
+    interval starts at min_poll and doubles up to max_poll while idle.
+
+    The clock is pluggable (now(), wait(event, timeout)) so the timing can
+    be driven by a fake clock.
+    """
+
+    def __init__(
+        self,
+        tasks=(),
+        min_poll=SCHEDULER_MIN_POLL,
+        max_poll=SCHEDULER_MAX_POLL,
+        clock=None,
+    ):
+        self.clock = clock if clock is not None else SystemClock()
+        self.min_poll = min_poll
+        self.max_poll = max_poll
+        self.poll = min_poll
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        now = self.clock.now()
+        self.due_at = {task: now for task in tasks}
+
+    def is_due(self, task):
+        with self.lock:
+            return self.clock.now() >= self.due_at.get(task, self.clock.now())
+
+    def done(self, task, next_due=None):
+        """
+        Record that task ran, it is due again at next_due, clamped to
+        [min_poll, max_poll] seconds from now.
+        """
+        now = self.clock.now()
+        latest = now + timedelta(seconds=self.max_poll)
+        earliest = now + timedelta(seconds=self.min_poll)
+        if next_due is None or next_due > latest:
+            next_due = latest
+        with self.lock:
+            self.due_at[task] = max(next_due, earliest)
+
+    def schedule(self, task, when):
+        """
+        Make task due at when, if that is earlier than planned.
+        """
+        with self.lock:
+            planned = self.due_at.get(task)
+            if planned is not None and planned <= when:
+                return
+            self.due_at[task] = when
+        logger.debug(f"{task} due at {when.isoformat()}")
+        self.wakeup.set()
+
+    def notify(self, task):
+        """
+        Make task due now and wake the loop.
+        """
+        self.schedule(task, self.clock.now())
+
+    def backoff(self, active):
+        """
+        Reset the poll interval after work was found, double it otherwise.
+        """
+        self.poll = self.min_poll if active else min(self.poll * 2, self.max_poll)
+
+    def next_wakeup(self):
+        with self.lock:
+            next_due = min(self.due_at.values(), default=None)
+        probe = self.clock.now() + timedelta(seconds=self.poll)
+        return probe if next_due is None else min(next_due, probe)
+
+    def wait(self):
+        """
+        Sleep until the next task is due, the poll interval passed or
+        notify() was called.
+        """
+        wake_at = self.next_wakeup()
+        timeout = max(0.0, (wake_at - self.clock.now()).total_seconds())
+        logger.debug(f"Sleeping {timeout:.1f}s until {wake_at.isoformat()}")
+        self.clock.wait(self.wakeup, timeout)
+        self.wakeup.clear()
@@ -1,25 +1,125 @@
+import gc
+import sys
 import pytz
 import chardet
+import codecs
+from collections.abc import MutableMapping
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from env import CSV_TZ, CSV_TIMEFORMAT
+from itertools import repeat
+from env import CSV_ENCODING, CSV_TZ, CSV_TIMEFORMAT, PLU_PARSE_BATCH_BYTES
 from modules.sduk.common import set_logger
 
 logger = set_logger("sduk")
 
+# What bytes.strip() removes, str.strip() would also remove e.g. NBSP (0xA0)
+_WHITESPACE = " \t\n\r\x0b\x0c"
+# What str.strip() removes on top of _WHITESPACE
+_UNICODE_WHITESPACE = (
+    "\x1c\x1d\x1e\x1f\x85\xa0\u1680\u2000\u2001\u2002\u2003\u2004\u2005"
+    "\u2006\u2007\u2008\u2009\u200a\u2028\u2029\u202f\u205f\u3000"
+)
+_NFC_URL_PREFIX = "https://www.superdrug.com/p/"
+# Bytes around a decoding error chardet looks at
+_DETECT_BYTES = 64 * 1024
+# Input bytes decoded at once when a file is decoded line by line
+_DECODE_BATCH_BYTES = 1024 * 1024
+
+
+@contextmanager
+def gc_paused():
+    """
+    Pause the cyclic garbage collector while building many acyclic objects,
+    its generation scans would otherwise walk them over and over.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+class FileDecoder:
+    """
+    Decodes the buffers of one file with one encoding, decided for the file.
+
+    The feed encoding is the fast path, a whole buffer is decoded in one
+    call. When a buffer does not decode with it, chardet detects the
+    encoding once from the bytes around the error and that encoding is used
+    for the rest of the file, undecodable bytes are replaced.
+    """
+
+    def __init__(self, encoding=CSV_ENCODING, name="file"):
+        self.encoding = encoding
+        self.name = name
+        self.detected = False
+
+    def decode(self, data: bytes) -> str:
+        try:
+            return data.decode(self.encoding)
+        except UnicodeDecodeError as e:
+            if not self.detected:
+                self.detect(data, e.start)
+        return data.decode(self.encoding, errors="replace")
+
+    def detect(self, data, position):
+        sample = data[max(0, position - _DETECT_BYTES // 2) :][:_DETECT_BYTES]
+        detection = chardet.detect(sample)
+        logger.error(
+            f"Decoding {self.name} as {self.encoding} failed, detected {detection['encoding']} with {detection['confidence']}"
+        )
+        self.detected = True
+        try:
+            self.encoding = codecs.lookup(detection["encoding"] or "").name
+        except LookupError:
+            pass
+
+
+def split_decoded_lines(text, separator):
+    """
+    Return the fields of every line of text, stripped like bytes.strip()
+    strips the fields of the encoded line. A blank line gives [""].
+    """
+    if any(c in text for c in _UNICODE_WHITESPACE):
+        return [
+            list(
+                map(
+                    str.strip,
+                    line.strip(_WHITESPACE).split(separator),
+                    repeat(_WHITESPACE),
+                )
+            )
+            for line in text.split("\n")
+        ]
+    # Without it both strip the same, str.strip() is about 2x faster without
+    # the characters to strip
+    return [
+        list(map(str.strip, line.strip().split(separator))) for line in text.split("\n")
+    ]
+
+
+def iter_decoded_rows(f, separator, decoder=None, batch_bytes=_DECODE_BATCH_BYTES):
+    """
+    Yield the fields of every line of the binary file f, like iterating f
+    and splitting and decoding each line. The lines are read and decoded in
+    batches of about batch_bytes, one decode call per batch.
+    """
+    decoder = decoder or FileDecoder()
+    while lines := f.readlines(batch_bytes):
+        text = decoder.decode(b"".join(lines))
+        yield from split_decoded_lines(
+            text[:-1] if text.endswith("\n") else text, separator
+        )
+
 
 def decode_text(byte_array: bytes = None) -> str:
     assert byte_array is not None
 
     if len(byte_array) == 0:
         return ""
-    try:
-        decoded_str = byte_array.decode(encoding="ISO-8859-1")
-    except:
-        detection = chardet.detect(byte_array)
-        logger.error(
-            f"Decoding Failed: {detection['encoding']} with {detection['confidence']}"
-        )
-    return decoded_str
+    return FileDecoder(name="field").decode(byte_array)
 
 
 def sduk_csv_parse_timestamp(
@@ -85,27 +185,30 @@ def sduk_csv_pe_parse_header(pe_file_header_line=None):
     return (startDate, endDate, promoType)
 
 
-def sduk_csv_sd_parse_items_into_articles(f=None):
+def sduk_csv_sd_parse_items_into_articles(f=None, column_plan=None):
     assert f is not None
 
-    plu_item_header_dict = read_file_to_list("resources/plu_item_headers.csv")
-    plu_item_dicts = []
-    for line in f:
-        item_dict = convert_line_to_dict(plu_item_header_dict, line)
-        plu_item_dicts.append(item_dict)
+    return PLUTable.read(f).articles(column_plan)
 
-    articles = convert_plu_items_to_articles(plu_item_dicts)
 
-    return articles
+def sduk_csv_sd_iter_items_into_articles(f=None, column_plan=None):
+    """
+    Yield the articles of a PLU item section, parsed batch by batch.
+    """
+    assert f is not None
+
+    for table in PLUTable.read_batches(f):
+        yield from table.articles(column_plan)
 
 
 def sduk_csv_pe0033_parse_items_into_articles(csv_file=None, header_postfix=""):
     assert csv_file is not None
 
     sduk_header = csv_file.readline()
+    rows = iter_decoded_rows(csv_file, ",", FileDecoder(name="PE0033 file"))
     item_headers = [
-        decode_text(header.strip().replace(b" ", b"_").replace(b"(xx_prom_desc)", b""))
-        for header in csv_file.readline().split(b",")
+        header.replace(" ", "_").replace("(xx_prom_desc)", "")
+        for header in next(rows, [""])
     ]
 
     if "0" in item_headers:
@@ -114,8 +217,8 @@ def sduk_csv_pe0033_parse_items_into_articles(csv_file=None, header_postfix=""):
     item_headers = [f"{header}{header_postfix}" for header in item_headers]
 
     pe_articles = {}
-    for line in csv_file:
-        item_dict = convert_line_to_dict(item_headers, line, seperator=b",")
+    for row in rows:
+        item_dict = dict(zip(item_headers, row))
         item_id = item_dict.pop(f"item{header_postfix}")
         if item_id == "=ROW()":
             continue
@@ -225,6 +328,377 @@ def convert_plu_items_to_articles(plu_item_dicts):
     return articles
 
 
+class ArticleSchema:
+    """
+    The data fields of the articles of one file, shared by their ArticleData.
+
+    Field names are interned. Fields with the same value in every article
+    (most PLU columns within a file) are shared, their value is held once
+    here, the other fields have a slot in each article's row. Deriving a
+    schema for the same field again returns the same schema.
+    """
+
+    __slots__ = (
+        "keys",
+        "slots",
+        "shared",
+        "width",
+        "template",
+        "positions",
+        "_derived",
+        "_subsets",
+        "_shared_empty",
+        "_projections",
+    )
+
+    def __init__(self, keys, shared=None):
+        shared = shared or {}
+        self.keys = tuple(sys.intern(key) for key in keys)
+        self.shared = tuple(shared.values())
+        # A slot >= 0 is a position in the row, ~slot one in shared
+        shared_slots = {key: ~i for i, key in enumerate(shared)}
+        self.slots = {}
+        self.width = 0
+        for key in self.keys:
+            if key in shared_slots:
+                self.slots[key] = shared_slots[key]
+            else:
+                self.slots[key] = self.width
+                self.width += 1
+        self._index()
+
+    def _index(self):
+        slots = [self.slots[key] for key in self.keys]
+        self.template = [self.shared[~slot] if slot < 0 else None for slot in slots]
+        self.positions = [0] * self.width
+        for position, slot in enumerate(slots):
+            if slot >= 0:
+                self.positions[slot] = position
+        self._derived = {}
+        self._subsets = {}
+        self._shared_empty = {}
+        self._projections = {}
+
+    def derived(self, key):
+        """
+        Return the schema with key in the next slot, for a new field or a
+        shared one an article sets to its own value.
+        """
+        schema = self._derived.get(key)
+        if schema is None:
+            schema = object.__new__(ArticleSchema)
+            schema.keys = (
+                self.keys if key in self.slots else self.keys + (sys.intern(key),)
+            )
+            schema.shared = self.shared
+            schema.slots = {**self.slots, key: self.width}
+            schema.width = self.width + 1
+            schema._index()
+            self._derived[key] = schema
+        return schema
+
+    def subset(self, keys):
+        """
+        Return the schema of keys (a tuple of fields of this schema), keeping
+        the shared values shared.
+        """
+        schema = self._subsets.get(keys)
+        if schema is None:
+            schema = object.__new__(ArticleSchema)
+            schema.keys = keys
+            schema.shared = self.shared
+            schema.slots = {}
+            schema.width = 0
+            for key in keys:
+                slot = self.slots[key]
+                if slot < 0:
+                    schema.slots[key] = slot
+                else:
+                    schema.slots[key] = schema.width
+                    schema.width += 1
+            schema._index()
+            self._subsets[keys] = schema
+        return schema
+
+    def projection(self, fields):
+        """
+        Return the schema of the fields (a tuple) this schema has, in the
+        order of fields, and the row slots of its own values.
+        """
+        projection = self._projections.get(fields)
+        if projection is None:
+            schema = self.subset(
+                tuple(field for field in fields if field in self.slots)
+            )
+            slots = [self.slots[key] for key in schema.keys if self.slots[key] >= 0]
+            projection = self._projections[fields] = (schema, slots)
+        return projection
+
+    def shared_empty(self, fields=None):
+        """
+        Return the shared fields of fields (all by default) with an empty
+        string value.
+        """
+        cache_key = None if fields is None else tuple(fields)
+        empty = self._shared_empty.get(cache_key)
+        if empty is None:
+            empty = frozenset(
+                key
+                for key, slot in self.slots.items()
+                if slot < 0
+                and self.shared[~slot] == ""
+                and (fields is None or key in fields)
+            )
+            self._shared_empty[cache_key] = empty
+        return empty
+
+    @classmethod
+    def for_rows(cls, keys, rows):
+        """
+        Return the schema of rows (lists aligned with keys) sharing the
+        fields with one value, and the values of the other fields per row.
+        """
+        if len(rows) < 2:
+            return cls(keys), [row[: len(keys)] for row in rows]
+        shared = {}
+        varying = []
+        for key, column in zip(keys, zip(*rows)):
+            if column.count(column[0]) == len(column):
+                shared[key] = column[0]
+            else:
+                varying.append(column)
+        schema = cls(keys, shared)
+        if not varying:
+            return schema, [[] for _ in rows]
+        return schema, list(map(list, zip(*varying)))
+
+
+class ArticleData(MutableMapping):
+    """
+    The data of one article as the values of its own fields, with the field
+    names and shared values in an ArticleSchema, instead of a dict per
+    article.
+
+    Behaves like the dict it replaces, setting a new field or a shared one
+    derives a schema. orjson serializes it to the same JSON with
+    default=article_json_default.
+    """
+
+    __slots__ = ("schema", "row")
+
+    def __init__(self, schema, row):
+        self.schema = schema
+        self.row = row
+
+    def __getitem__(self, key):
+        slot = self.schema.slots[key]
+        return self.row[slot] if slot >= 0 else self.schema.shared[~slot]
+
+    def __setitem__(self, key, value):
+        slot = self.schema.slots.get(key)
+        if slot is not None and slot >= 0:
+            self.row[slot] = value
+        elif slot is None or self.schema.shared[~slot] != value:
+            self.schema = self.schema.derived(key)
+            self.row.append(value)
+
+    def __delitem__(self, key):
+        data = self.as_dict()
+        del data[key]
+        self.schema = ArticleSchema(data)
+        self.row = list(data.values())
+
+    def __contains__(self, key):
+        return key in self.schema.slots
+
+    def __iter__(self):
+        return iter(self.schema.keys)
+
+    def __len__(self):
+        return len(self.schema.keys)
+
+    def __repr__(self):
+        return f"ArticleData({self.as_dict()!r})"
+
+    def get(self, key, default=None):
+        slot = self.schema.slots.get(key)
+        if slot is None:
+            return default
+        return self.row[slot] if slot >= 0 else self.schema.shared[~slot]
+
+    def without_empty(self, fields=None):
+        """
+        Return the data without the fields of fields (all by default) with
+        an empty string value, the articles missing the same fields share a
+        schema.
+        """
+        schema = self.schema
+        dropped = set(schema.shared_empty(fields))
+        for position, value in zip(schema.positions, self.row):
+            if value == "":
+                key = schema.keys[position]
+                if fields is None or key in fields:
+                    dropped.add(key)
+        if not dropped:
+            return self
+        slots = schema.slots
+        subset = schema.subset(tuple(key for key in schema.keys if key not in dropped))
+        return ArticleData(
+            subset, [self.row[slots[key]] for key in subset.keys if slots[key] >= 0]
+        )
+
+    def project(self, fields):
+        """
+        Return the data of the fields (a tuple) it has, in the order of
+        fields, the articles of its schema share the projected one.
+        """
+        schema, slots = self.schema.projection(fields)
+        row = self.row
+        return ArticleData(schema, [row[slot] for slot in slots])
+
+    def as_dict(self):
+        values = self.schema.template.copy()
+        for position, value in zip(self.schema.positions, self.row):
+            values[position] = value
+        return dict(zip(self.schema.keys, values))
+
+
+def article_json_default(obj):
+    """
+    orjson default serializing ArticleData as the dict it stands for.
+    """
+    if isinstance(obj, ArticleData):
+        return obj.as_dict()
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def compact_articles(articles):
+    """
+    Replace the data dicts of articles by ArticleData, articles with the
+    same data fields share one schema. Returns articles.
+    """
+    groups = {}
+    for article in articles:
+        data = article.get("data")
+        if type(data) is dict:
+            groups.setdefault(tuple(data), []).append(article)
+    for keys, group in groups.items():
+        schema, values = ArticleSchema.for_rows(
+            keys, [list(article["data"].values()) for article in group]
+        )
+        for article, article_values in zip(group, values):
+            article["data"] = ArticleData(schema, article_values)
+    return articles
+
+
+class PLUTable:
+    """
+    PLU items as columns, parsed from a whole file in one bulk pass.
+
+    The file is decoded once as a whole (FileDecoder) instead of per field,
+    and rows are split and stripped with C-level str methods. Derived article
+    values (articleId, eans, nfcUrl) are computed per column, article dicts
+    are only built by articles(). Same results as convert_line_to_dict() and
+    convert_plu_items_to_articles() on every non-blank line.
+
+    The data of the articles is ArticleData, the columns with one value in
+    the whole table are held once by their schema. A column plan (columns,
+    select(row) -> values) keeps only its columns.
+    """
+
+    def __init__(self, headers, rows):
+        self.headers = headers
+        self.rows = rows
+        self.index = {header: i for i, header in enumerate(headers)}
+
+    @classmethod
+    def read(cls, f, header_file="resources/plu_item_headers.csv"):
+        """
+        Read the PLU item lines of f, positioned after the file header.
+        """
+        return cls.parse(f.read(), read_file_to_list(filename=header_file))
+
+    @classmethod
+    def read_batches(
+        cls,
+        f,
+        header_file="resources/plu_item_headers.csv",
+        batch_bytes=PLU_PARSE_BATCH_BYTES,
+    ):
+        """
+        Yield the PLU item lines of f as tables of about batch_bytes of input,
+        only the current batch is held in memory.
+        """
+        headers = read_file_to_list(filename=header_file)
+        decoder = FileDecoder(name="PLU file")
+        while lines := f.readlines(batch_bytes):
+            yield cls.parse(b"".join(lines), headers, decoder)
+
+    @classmethod
+    def parse(cls, data, headers, decoder=None):
+        text = (decoder or FileDecoder(name="PLU file")).decode(data)
+        with gc_paused():
+            rows = [
+                row for row in split_decoded_lines(text, "|") if len(row) > 1 or row[0]
+            ]
+        return cls(headers, rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def column(self, header):
+        position = self.index[header]
+        return [row[position] for row in self.rows]
+
+    def article_ids(self):
+        return [value.lstrip("0") for value in self.column("INTRNL_ID")]
+
+    def eans(self):
+        return [ean_padding(value.lstrip("0")) for value in self.column("ITM_ID")]
+
+    def article_data(self, column_plan=None):
+        """
+        Return the ArticleData of every row, sharing one schema.
+        """
+        headers = self.headers
+        rows = self.rows
+        if column_plan is not None:
+            headers = column_plan.columns
+            rows = list(map(column_plan.select, rows))
+        widths = {len(row) for row in rows}
+        if len(widths) == 1:
+            # Rows only get the fields they have, like a zip() into a dict
+            keys = headers[: widths.pop()]
+            schema, values = ArticleSchema.for_rows(keys, rows)
+            return [ArticleData(schema, row_values) for row_values in values]
+        schemas = {}
+        data = []
+        for row in rows:
+            row = row[: len(headers)]
+            if len(row) not in schemas:
+                schemas[len(row)] = ArticleSchema(headers[: len(row)])
+            data.append(ArticleData(schemas[len(row)], row))
+        return data
+
+    def articles(self, column_plan=None):
+        article_ids = self.article_ids()
+        names = self.column("DSPL_DESCR")
+        eans = self.eans()
+        with gc_paused():
+            return [
+                {
+                    "articleId": article_id,
+                    "articleName": name,
+                    "nfcUrl": _NFC_URL_PREFIX + article_id,
+                    "eans": article_eans,
+                    "data": data,
+                }
+                for article_id, name, article_eans, data in zip(
+                    article_ids, names, eans, self.article_data(column_plan)
+                )
+            ]
+
+
 def convert_pe0033_items_to_articles(pe_articles):
     articles = []
     for article_id in pe_articles:
@@ -242,7 +716,7 @@ def convert_pe0033_items_to_articles(pe_articles):
         #     print(f"NOBUL: {article}")
         articles.append(article)
 
-    return articles
+    return compact_articles(articles)
 
 
 def remove_leading_zeros(text):
@@ -0,0 +1,55 @@
+import struct
+import zlib
+import orjson
+from modules.sduk.sduk import article_json_default
+from env import BLOB_SIDECAR_DIR
+
+# Bump whenever the parse or merge of PLU/PE0033 articles changes, older
+# sidecars are then detected as stale and rebuilt from their CSV blob.
+SIDECAR_VERSION = 2
+SIDECAR_MAGIC = b"SDUKART"
+_VERSION_FORMAT = ">H"
+_HEADER_LENGTH = len(SIDECAR_MAGIC) + struct.calcsize(_VERSION_FORMAT)
+
+
+class SidecarError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+
+def sidecar_blob_name(blob_name=None, sidecar_dir=BLOB_SIDECAR_DIR):
+    """
+    Name of the pre-parsed sidecar of a queued or active CSV blob.
+    """
+    assert blob_name is not None
+    return f"{sidecar_dir}/{blob_name}.articles"
+
+
+def encode_sidecar(payload):
+    """
+    Serialize already parsed and merged article records.
+
+    The payload is stored as zlib-compressed JSON behind a magic and version
+    header.
+    """
+    return (
+        SIDECAR_MAGIC
+        + struct.pack(_VERSION_FORMAT, SIDECAR_VERSION)
+        + zlib.compress(orjson.dumps(payload, default=article_json_default), 6)
+    )
+
+
+def decode_sidecar(data):
+    """
+    Return the payload of a sidecar, raising SidecarError if it was written by
+    another sidecar version or is damaged.
+    """
+    if not data.startswith(SIDECAR_MAGIC):
+        raise SidecarError("not a sidecar")
+    (version,) = struct.unpack_from(_VERSION_FORMAT, data, len(SIDECAR_MAGIC))
+    if version != SIDECAR_VERSION:
+        raise SidecarError(f"sidecar version {version}, expected {SIDECAR_VERSION}")
+    try:
+        return orjson.loads(zlib.decompress(data[_HEADER_LENGTH:]))
+    except (zlib.error, orjson.JSONDecodeError) as e:
+        raise SidecarError(f"damaged sidecar: {e}")
@@ -0,0 +1,20 @@
+from modules.sduk.pipeline import iter_batches
+
+# sqlite host parameter limit is 999 on older builds
+QUERY_BATCH = 900
+
+
+def select_in(db=None, query=None, values=None, params=(), batch=QUERY_BATCH):
+    """
+    Yield the rows of query for all values, run once per batch of values
+    with its "IN ({})" filled with one placeholder per value, params bind
+    the placeholders before it.
+    """
+    assert db is not None
+    assert query is not None
+    assert values is not None
+    for batch_values in iter_batches(values, batch - len(params)):
+        yield from db.execute(
+            query.format(",".join("?" * len(batch_values))),
+            [*params, *batch_values],
+        )
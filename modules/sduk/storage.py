@@ -0,0 +1,303 @@
+import io
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from azure.core import exceptions as azure_exceptions
+from modules.sduk.common import set_logger
+from env import (
+    BLOB_DELETE_LINGER,
+    BLOB_MOVE_WORKERS,
+    BLOB_RANGE_BLOCK_SIZE,
+    LOCAL_STORAGE_PATH,
+    STORAGE_BACKEND,
+)
+
+logger = set_logger("Blob Store")
+
+
+class BlobError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+
+class RangedBlobFile(io.RawIOBase):
+    """
+    Read-only, seekable file object over a blob that fetches byte ranges on
+    demand.
+
+    Small reads are served from a block_size read-ahead block, so ZipFile
+    reading the central directory and local headers costs a few requests,
+    while large member reads are fetched as one range. bytes_fetched and requests count
+    what was actually transferred of the blob size.
+    """
+
+    def __init__(self, blob_client, size=None, block_size=BLOB_RANGE_BLOCK_SIZE):
+        self.blob_client = blob_client
+        self.size = size if size is not None else blob_client.get_blob_properties().size
+        self.block_size = block_size
+        self.position = 0
+        self.block_start = 0
+        self.block = b""
+        self.bytes_fetched = 0
+        self.requests = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"invalid whence {whence}")
+        if position < 0:
+            raise OSError(f"negative seek position {position}")
+        self.position = position
+        return position
+
+    def _fetch(self, offset, length):
+        data = self.blob_client.download_blob(offset=offset, length=length).readall()
+        self.bytes_fetched += len(data)
+        self.requests += 1
+        return data
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast("B")
+        length = min(len(view), max(0, self.size - self.position))
+        filled = 0
+        while filled < length:
+            remaining = length - filled
+            block_end = self.block_start + len(self.block)
+            if self.block_start <= self.position < block_end:
+                start = self.position - self.block_start
+                count = min(remaining, block_end - self.position)
+                view[filled : filled + count] = self.block[start : start + count]
+            elif remaining >= self.block_size:
+                data = self._fetch(self.position, remaining)
+                count = len(data)
+                if count == 0:
+                    break
+                view[filled : filled + count] = data
+            else:
+                self.block_start = self.position
+                self.block = self._fetch(
+                    self.block_start, min(self.block_size, self.size - self.block_start)
+                )
+                if not self.block:
+                    break
+                continue
+            filled += count
+            self.position += count
+        return filled
+
+    def stats(self):
+        return f"fetched {self.bytes_fetched}/{self.size} bytes in {self.requests} requests"
+
+
+class BlobStore:
+    """
+    Storage of the input, queue, active and archive blobs.
+
+    Blob names are "/" separated paths. Implementations provide the
+    listings, get_blob(), copy_blob(), delete_blobs(), _acquire_lease() and
+    _break_lease(). The blob handles of get_blob() offer the part of the
+    Azure BlobClient API the adapter uses: upload_blob(data, overwrite),
+    download_blob(offset, length) with readall() and readinto(),
+    get_blob_properties().size, exists() and delete_blob(lease). Missing
+    blobs, existing blobs and taken leases raise the azure.core
+    ResourceNotFoundError and ResourceExistsError for every backend.
+    """
+
+    # Most deletes one delete_blobs() call is given
+    batch_size = 1
+
+    def __init__(self):
+        self.lease_breaker = {}
+        self.mover = ThreadPoolExecutor(
+            max_workers=BLOB_MOVE_WORKERS, thread_name_prefix="blob-move"
+        )
+        self.delete_lock = threading.Lock()
+        self.pending_deletes = []
+        self.delete_timer = None
+
+    def list_blobs(self, name_starts_with=""):
+        raise NotImplementedError
+
+    def iter_blobs_with_properties(self, name_starts_with=""):
+        """
+        Yield (blob name, size) in name order.
+        """
+        raise NotImplementedError
+
+    def list_blob_etags(self, name_starts_with=""):
+        """
+        Return {blob name: ETag}, changes whenever a blob is added, replaced
+        or removed.
+        """
+        raise NotImplementedError
+
+    def list_blob_names_in_dir(self, dir_name=None):
+        """
+        Return the names of the blobs directly in dir_name, blobs in
+        subdirectories are left out.
+        """
+        raise NotImplementedError
+
+    def get_blob(self, blob=None):
+        raise NotImplementedError
+
+    def copy_blob(self, src_name=None, tgt_name=None, data=None):
+        raise NotImplementedError
+
+    def delete_blobs(self, blobs):
+        """
+        Delete [(blob name, lease or None)], blobs already gone count as
+        deleted.
+
+        Returns:
+            dict: Maps every blob that could not be deleted to a BlobError.
+        """
+        raise NotImplementedError
+
+    def _acquire_lease(self, blob, lease_duration):
+        raise NotImplementedError
+
+    def _break_lease(self, blob):
+        raise NotImplementedError
+
+    def list_blobs_with_properties(self, name_starts_with=""):
+        """
+        Return {blob name: size} from one listing instead of a
+        get_blob_properties() call per blob.
+        """
+        return dict(self.iter_blobs_with_properties(name_starts_with))
+
+    def get_blob_with_lease(self, blob_name=None, lease_duration=-1, size=None):
+        """
+        Acquire a lease on blob_name. Pass the size known from
+        list_blobs_with_properties() to skip fetching the properties first.
+        """
+        assert blob_name is not None
+        blob = self.get_blob(blob_name)
+        now = datetime.now()
+        if size is None:
+            size = blob.get_blob_properties().size
+        if size == 0:
+            raise BlobError(f"{blob_name} - size=0")
+        try:
+            blob_lease = self._acquire_lease(blob, lease_duration)
+        except azure_exceptions.ResourceExistsError as e:
+            if blob_name not in self.lease_breaker:
+                self.lease_breaker[blob_name] = now
+            else:
+                lease_delta = now - self.lease_breaker[blob_name]
+                logger.error(f"Stale lease for {blob_name} found {lease_delta} old")
+                if lease_delta > timedelta(minutes=5):
+                    logger.error("Stale Lease older than 5 minutes -> Breaking")
+                    self._break_lease(blob)
+            raise e
+        if blob_name in self.lease_breaker:
+            self.lease_breaker.pop(blob_name)
+        return blob, blob_lease
+
+    def delete_later(self, blob_name=None, lease=None):
+        """
+        Queue blob_name for a batch delete and return a Future of it. The
+        batch is sent when batch_size deletes are queued or
+        BLOB_DELETE_LINGER seconds after the first one.
+        """
+        assert blob_name is not None
+        future = Future()
+        with self.delete_lock:
+            self.pending_deletes.append((blob_name, lease, future))
+            is_full = len(self.pending_deletes) >= self.batch_size
+            if not is_full and self.delete_timer is None:
+                self.delete_timer = threading.Timer(
+                    BLOB_DELETE_LINGER, self.flush_deletes
+                )
+                self.delete_timer.daemon = True
+                self.delete_timer.start()
+        if is_full:
+            self.flush_deletes()
+        return future
+
+    def flush_deletes(self):
+        with self.delete_lock:
+            pending, self.pending_deletes = self.pending_deletes, []
+            if self.delete_timer is not None:
+                self.delete_timer.cancel()
+                self.delete_timer = None
+        if not pending:
+            return
+        try:
+            failures = self.delete_blobs((name, lease) for name, lease, _ in pending)
+        except Exception as e:
+            # Never leave the futures unresolved, callers wait on them
+            logger.error(f"Batch delete of {len(pending)} blobs failed: {e}")
+            failures = {name: e for name, _, _ in pending}
+        for name, _, future in pending:
+            if name in failures:
+                future.set_exception(failures[name])
+            else:
+                future.set_result(True)
+
+    def move_blob(
+        self, src_name=None, tgt_name=None, src_lease=None, data=None, background=False
+    ):
+        """
+        Copy and delete src_name, returns whether it was moved. With
+        background=True the move runs on a worker thread and a Future of
+        that result is returned instead.
+        """
+        if background:
+            # The delete of the source joins the next batch delete
+            moved = Future()
+
+            def deleted(delete):
+                if delete.exception() is not None:
+                    moved.set_exception(delete.exception())
+                else:
+                    moved.set_result(True)
+
+            def copied(copy):
+                if copy.exception() is not None:
+                    moved.set_exception(copy.exception())
+                elif not copy.result():
+                    moved.set_result(False)
+                else:
+                    logger.debug(f"Deleting {src_name}")
+                    self.delete_later(src_name, src_lease).add_done_callback(deleted)
+
+            self.mover.submit(
+                self.copy_blob, src_name, tgt_name, data=data
+            ).add_done_callback(copied)
+            return moved
+        if self.copy_blob(src_name, tgt_name, data=data):
+            logger.debug(f"Deleting {src_name}")
+            self.get_blob(src_name).delete_blob(lease=src_lease)
+            return True
+        return False
+
+
+def open_blob_store(backend=STORAGE_BACKEND):
+    """
+    Return the blob store selected by STORAGE_BACKEND, "azure" or "local".
+    """
+    if backend == "azure":
+        from modules.sduk.blob import AzureBlob
+
+        return AzureBlob()
+    if backend == "local":
+        from modules.sduk.local_blob import LocalBlobStore
+
+        return LocalBlobStore(LOCAL_STORAGE_PATH)
+    raise ValueError(f"Unknown STORAGE_BACKEND {backend}")
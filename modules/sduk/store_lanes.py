@@ -0,0 +1,121 @@
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from modules.sduk.common import set_logger
+from env import STORE_FANOUT_WORKERS
+
+logger = set_logger("Store Lanes")
+
+
+class StoreLanes:
+    """
+    One ordered work queue per store code, drained by a shared worker pool.
+
+    Work submitted for a store runs in submission order, one item at a time,
+    while different stores run in parallel on up to max_workers threads. A
+    lane gives its worker back after every item, so a store with a long
+    backlog or a slow AIMS response only delays its own work.
+    """
+
+    def __init__(self, max_workers=STORE_FANOUT_WORKERS):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max(1, max_workers), thread_name_prefix="store-lane"
+        )
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.lanes = {}
+
+    def submit(self, store_id, func, *args, **kwargs):
+        """
+        Queue func(*args, **kwargs) on the lane of store_id, return its Future.
+        """
+        future = Future()
+        with self.lock:
+            lane = self.lanes.get(store_id)
+            if lane is not None:
+                lane.append((future, func, args, kwargs))
+                return future
+            self.lanes[store_id] = deque([(future, func, args, kwargs)])
+        self.executor.submit(self._run_next, store_id)
+        return future
+
+    def submit_to_stores(self, store_ids, func, *args, **kwargs):
+        """
+        Queue func(store_id, *args, **kwargs) on every store's lane.
+
+        Returns:
+            dict: Maps every store id to the Future of its call.
+        """
+        return {
+            store_id: self.submit(store_id, func, store_id, *args, **kwargs)
+            for store_id in store_ids
+        }
+
+    def _run_next(self, store_id):
+        with self.lock:
+            future, func, args, kwargs = self.lanes[store_id].popleft()
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(func(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+        with self.lock:
+            if self.lanes[store_id]:
+                # Back to the end of the pool queue, other stores go first
+                self.executor.submit(self._run_next, store_id)
+                return
+            del self.lanes[store_id]
+            if not self.lanes:
+                self.idle.notify_all()
+
+    def pending(self):
+        """
+        Return {store_id: items still queued behind the running one} of all
+        busy lanes.
+        """
+        with self.lock:
+            return {store_id: len(lane) for store_id, lane in self.lanes.items()}
+
+    def join(self, timeout=None):
+        """
+        Wait until every lane is drained, return False on timeout.
+        """
+        with self.lock:
+            return self.idle.wait_for(lambda: not self.lanes, timeout=timeout)
+
+    def shutdown(self):
+        self.join()
+        self.executor.shutdown()
+
+
+def when_all_done(futures, callback):
+    """
+    Call callback(failures) once every future is done, failures maps the keys
+    of futures (a dict) or their positions (any other iterable) to the raised
+    exception. Runs immediately when there is nothing to wait for.
+    """
+    if not isinstance(futures, dict):
+        futures = dict(enumerate(futures))
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        failures = {
+            key: future.exception()
+            for key, future in futures.items()
+            if future.exception() is not None
+        }
+        try:
+            callback(failures)
+        except Exception as e:
+            logger.exception(f"Completion callback failed: {e}")
+
+    if not futures:
+        callback({})
+        return
+    for future in futures.values():
+        future.add_done_callback(done)